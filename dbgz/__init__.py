@@ -3,6 +3,13 @@
 from .dbgz import DBGZWriter
 from .dbgz import DBGZReader
 from .dbgz import readIndicesDictionary
+from .index import SortedIndexWriter
+from .index import SortedIndex
+from .index import InvertedIndexWriter
+from .index import InvertedIndex
+from .tools import concat
+from .tools import shard
+from .tools import sort
 
 __version__ = "0.5.4"
 
@@ -247,11 +247,18 @@ If your data is in UTF-8 or any other incompatible encoding, you must use
 binary mode, and decode the appropriate fragments yourself.
 """
 
+import mmap
+import os
 import struct
 import sys
 import zlib
 
+from array import array
+from bisect import bisect_right
 from builtins import open as _open
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 _bgzf_magic = b"\x1f\x8b\x08\x04"
 _bgzf_header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
@@ -429,12 +436,59 @@ def BgzfBlocks(handle):
         data_start += data_len
 
 
+def BgzfBlockStarts(handle, start_offset=0):
+    """Iterate over the BGZF blocks of a file without decompressing them.
+
+    Expects a binary handle from the builtin open function (as for
+    BgzfBlocks). Yields a tuple (block start offset, block length) for
+    each block from start_offset on, stopping at the end of the file or
+    at the first empty block (the EOF marker), so any data stored after
+    the EOF marker is never parsed.
+    """
+    if isinstance(handle, BgzfReader):
+        raise TypeError("Function BgzfBlockStarts expects a binary handle")
+    handle.seek(start_offset)
+    while True:
+        header = handle.read(18)
+        if not header:
+            break
+        if header[:4] != _bgzf_magic:
+            raise ValueError(
+                r"A BGZF (e.g. a BAM file) block should start with "
+                r"%r, not %r; offset is %r" % (_bgzf_magic, header[:4], start_offset)
+            )
+        if header[12:14] == _bytes_BC and struct.unpack("<H", header[10:12])[0] == 6:
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+        else:
+            # Other extra subfields, let the full parser find the BC one
+            handle.seek(start_offset)
+            block_size = _read_bgzf_block(handle)[0]
+        handle.seek(start_offset + block_size - 4)
+        data_len = struct.unpack("<I", handle.read(4))[0]
+        if not data_len:
+            break
+        yield start_offset, block_size
+        start_offset += block_size
+
+
 def _load_bgzf_block(handle, text_mode=False):
     """Load the next BGZF block of compressed data (PRIVATE).
 
     Returns a tuple (block size and data), or at end of file
     will raise StopIteration.
     """
+    block_size, deflated, expected_crc, expected_size = _read_bgzf_block(handle)
+    return block_size, _inflate_bgzf_block(
+        deflated, expected_crc, expected_size, text_mode
+    )
+
+
+def _read_bgzf_block(handle):
+    """Read the next BGZF block without decompressing it (PRIVATE).
+
+    Returns a tuple (block size, deflated data, CRC and length of the
+    uncompressed data), or at end of file will raise StopIteration.
+    """
     magic = handle.read(4)
     if not magic:
         # End of file - should we signal this differently now?
@@ -465,10 +519,63 @@ def _load_bgzf_block(handle, text_mode=False):
     assert block_size is not None, "Missing BC, this isn't a BGZF file!"
     # Now comes the compressed data, CRC, and length of uncompressed data.
     deflate_size = block_size - 1 - extra_len - 19
-    d = zlib.decompressobj(-15)  # Negative window size means no headers
-    data = d.decompress(handle.read(deflate_size)) + d.flush()
+    deflated = handle.read(deflate_size)
     expected_crc = handle.read(4)
     expected_size = struct.unpack("<I", handle.read(4))[0]
+    return block_size, deflated, expected_crc, expected_size
+
+
+def _load_bgzf_block_from(buffer, offset, text_mode=False):
+    """Load the BGZF block at offset of a buffer such as a mmap (PRIVATE).
+
+    Like _load_bgzf_block, but the compressed data is decompressed straight
+    from the buffer instead of being read from a handle first.
+    """
+    if offset >= len(buffer):
+        raise StopIteration
+    magic = buffer[offset : offset + 4]
+    if magic != _bgzf_magic:
+        raise ValueError(
+            r"A BGZF (e.g. a BAM file) block should start with "
+            r"%r, not %r; offset is %r" % (_bgzf_magic, magic, offset)
+        )
+    gzip_mod_time, gzip_extra_flags, gzip_os, extra_len = struct.unpack_from(
+        "<LBBH", buffer, offset + 4
+    )
+
+    block_size = None
+    x_len = 0
+    pointer = offset + 12
+    while x_len < extra_len:
+        subfield_id = buffer[pointer : pointer + 2]
+        subfield_len = struct.unpack_from("<H", buffer, pointer + 2)[0]  # uint16_t
+        if subfield_id == _bytes_BC:
+            assert subfield_len == 2, "Wrong BC payload length"
+            assert block_size is None, "Two BC subfields?"
+            block_size = struct.unpack_from("<H", buffer, pointer + 4)[0] + 1
+        pointer += subfield_len + 4
+        x_len += subfield_len + 4
+    assert x_len == extra_len, (x_len, extra_len)
+    assert block_size is not None, "Missing BC, this isn't a BGZF file!"
+    deflate_size = block_size - 1 - extra_len - 19
+    expected_crc = buffer[pointer + deflate_size : pointer + deflate_size + 4]
+    expected_size = struct.unpack_from("<I", buffer, pointer + deflate_size + 4)[0]
+    # A view, so the compressed data is not copied out of the buffer
+    with memoryview(buffer) as view:
+        with view[pointer : pointer + deflate_size] as deflated:
+            data = _inflate_bgzf_block(
+                deflated, expected_crc, expected_size, text_mode
+            )
+    return block_size, data
+
+
+def _inflate_bgzf_block(deflated, expected_crc, expected_size, text_mode=False):
+    """Decompress and check the data read by _read_bgzf_block (PRIVATE).
+
+    Like _compress_bgzf_block, this is safe to run on a worker thread.
+    """
+    d = zlib.decompressobj(-15)  # Negative window size means no headers
+    data = d.decompress(deflated) + d.flush()
     if expected_size != len(data):
         raise RuntimeError("Decompressed to %i, not %i" % (len(data), expected_size))
     # Should cope with a mix of Python platforms...
@@ -482,9 +589,38 @@ def _load_bgzf_block(handle, text_mode=False):
     if text_mode:
         # Note ISO-8859-1 aka Latin-1 preserves first 256 chars
         # (i.e. ASCII), but critically is a single byte encoding
-        return block_size, data.decode("latin-1")
+        return data.decode("latin-1")
     else:
-        return block_size, data
+        return data
+
+
+def _compress_bgzf_block(block, compresslevel=6):
+    """Compress data into a single BGZF block, returned as bytes (PRIVATE).
+
+    zlib releases the GIL while deflating, so this can run on a worker
+    thread when compressing several blocks concurrently.
+    """
+    # Giving a negative window bits means no gzip/zlib headers,
+    # -15 used in samtools
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, 0)
+    compressed = c.compress(block) + c.flush()
+    del c
+    if len(compressed) > 65536:
+        raise RuntimeError(
+            "TODO - Didn't compress enough, try less data in this block"
+        )
+    bsize = struct.pack("<H", len(compressed) + 25)  # includes -1
+    crc = struct.pack("<I", zlib.crc32(block) & 0xFFFFFFFF)
+    uncompressed_length = struct.pack("<I", len(block))
+    # Fixed 16 bytes,
+    # gzip magic bytes (4) mod time (4),
+    # gzip flag (1), os (1), extra length which is six (2),
+    # sub field which is BC (2), sub field length of two (2),
+    # Variable data,
+    # 2 bytes: block length as BC sub field (2)
+    # X bytes: the data
+    # 8 bytes: crc (4), uncompressed data length (4)
+    return _bgzf_header + bsize + compressed + crc + uncompressed_length
 
 
 class BgzfReader:
@@ -545,19 +681,55 @@ class BgzfReader:
     2
     >>> handle.close()
 
-    Note that you can use the max_cache argument to limit the number of
-    BGZF blocks cached in memory. The default is 100, and since each
-    block can be up to 64kb, the default cache could take up to 6MB of
-    RAM. The cache is not important for reading through the file in one
-    pass, but is important for improving performance of random access.
+    Note that you can use the cache_size argument to limit the number of
+    bytes of decompressed BGZF blocks cached in memory, the least recently
+    used blocks being dropped first. If not given, it is max_cache blocks
+    of 64kb each, and since the default max_cache is 100 the default cache
+    could take up to 6MB of RAM. The cache is not important for reading
+    through the file in one pass, but is important for improving
+    performance of random access. The cache_info method reports the hits,
+    misses and evictions of the cache.
+
+    With use_mmap the file is memory mapped and the compressed blocks are
+    decompressed straight from the mapping. In binary mode the read_view
+    method returns the data as a memoryview of the decompressed block
+    (without copying it) whenever it does not cross a block boundary.
+
+    For sequential scans, the readahead argument sets how many of the
+    upcoming BGZF blocks are read and decompressed in the background
+    (using a pool of threads worker threads) while the current block is
+    being consumed. Prefetched blocks go through the same cache, and a
+    seek outside of the prefetched range simply restarts the pipeline.
+
+    For random access, the prefetch method loads a list of blocks into the
+    cache at once, reading them in file order and decompressing them in
+    parallel when threads is larger than 1.
     """
 
-    def __init__(self, filename=None, mode="r", fileobj=None, max_cache=100):
+    def __init__(
+        self,
+        filename=None,
+        mode="r",
+        fileobj=None,
+        max_cache=100,
+        cache_size=None,
+        readahead=0,
+        threads=1,
+        use_mmap=False,
+    ):
         """Initialize the class."""
         # TODO - Assuming we can seek, check for 28 bytes EOF empty block
         # and if missing warn about possible truncation (as in samtools)?
         if max_cache < 1:
             raise ValueError("Use max_cache with a minimum of 1")
+        if cache_size is None:
+            cache_size = max_cache * 65536
+        if cache_size < 1:
+            raise ValueError("Use cache_size with a minimum of 1")
+        if readahead < 0:
+            raise ValueError("Use readahead with a minimum of 0")
+        if threads < 1:
+            raise ValueError("Use threads with a minimum of 1")
         # Must open the BGZF file in binary mode, but we may want to
         # treat the contents as either text or binary (unicode or
         # bytes under Python 3)
@@ -578,9 +750,33 @@ class BgzfReader:
             self._newline = b"\n"
         self._handle = handle
         self.max_cache = max_cache
-        self._buffers = {}
+        self.cache_size = cache_size
+        self._buffers = OrderedDict()
+        self._cache_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
         self._block_start_offset = None
         self._block_raw_length = None
+        self._view = None
+        self._view_source = None
+        if use_mmap:
+            self._mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = None
+        self.readahead = readahead
+        self.threads = threads
+        self._inflate_executor = None
+        self._readahead_queue = deque()
+        self._readahead_state = [None]
+        if readahead:
+            # The background reads use their own handle, so they never move
+            # the position of the main one.
+            self._readahead_handle = _open(handle.name, "rb")
+            self._readahead_executor = ThreadPoolExecutor(max_workers=1)
+            self._inflate_executor = ThreadPoolExecutor(max_workers=threads)
+        else:
+            self._readahead_handle = None
         self._load_block(handle.tell())
 
     def _load_block(self, start_offset=None):
@@ -594,32 +790,184 @@ class BgzfReader:
             return
         elif start_offset in self._buffers:
             # Already in cache
+            self._buffers.move_to_end(start_offset)
+            self.cache_hits += 1
             self._buffer, self._block_raw_length = self._buffers[start_offset]
             self._within_block_offset = 0
             self._block_start_offset = start_offset
             return
-        # Must hit the disk... first check cache limits,
-        while len(self._buffers) >= self.max_cache:
-            # TODO - Implemente LRU cache removal?
-            self._buffers.popitem()
-        # Now load the block
+        # Must hit the disk...
+        self.cache_misses += 1
+        prefetched = None
+        if self.readahead:
+            prefetched = self._take_readahead(start_offset)
+        if prefetched is not None:
+            self._block_start_offset = start_offset
+            self._buffer, block_size = prefetched
+        elif self._mmap is not None:
+            self._block_start_offset = start_offset
+            try:
+                block_size, self._buffer = _load_bgzf_block_from(
+                    self._mmap, start_offset, self._text
+                )
+            except StopIteration:
+                # EOF
+                block_size = 0
+                if self._text:
+                    self._buffer = ""
+                else:
+                    self._buffer = b""
+        else:
+            handle = self._handle
+            if start_offset is not None:
+                handle.seek(start_offset)
+            self._block_start_offset = handle.tell()
+            try:
+                block_size, self._buffer = _load_bgzf_block(handle, self._text)
+            except StopIteration:
+                # EOF
+                block_size = 0
+                if self._text:
+                    self._buffer = ""
+                else:
+                    self._buffer = b""
+        self._within_block_offset = 0
+        self._block_raw_length = block_size
+        # Finally save the block in our cache
+        self._cache_block(self._block_start_offset, self._buffer, block_size)
+        if self.readahead and self._buffer:
+            self._fill_readahead(self._block_start_offset + block_size)
+
+    def _cache_block(self, start_offset, buffer, block_size):
+        """Save a block in the cache (PRIVATE).
+
+        The least recently used blocks (but never the new one) are dropped
+        to stay within the budget.
+        """
+        buffers = self._buffers
+        buffers[start_offset] = buffer, block_size
+        self._cache_bytes += len(buffer)
+        while self._cache_bytes > self.cache_size and len(buffers) > 1:
+            _, (old_buffer, _) = buffers.popitem(last=False)
+            self._cache_bytes -= len(old_buffer)
+            self.cache_evictions += 1
+
+    def prefetch(self, start_offsets):
+        """Load the blocks starting at the given file offsets into the cache.
+
+        Blocks already in the cache are skipped, the others are read in file
+        order and decompressed using threads worker threads. Blocks that
+        don't fit in the cache budget push out the least recently used ones,
+        so the list should be shorter than the cache.
+        """
         handle = self._handle
-        if start_offset is not None:
+        position = handle.tell()
+        loaded = []
+        for start_offset in sorted(set(start_offsets)):
+            if start_offset in self._buffers:
+                continue
             handle.seek(start_offset)
-        self._block_start_offset = handle.tell()
+            try:
+                loaded.append((start_offset, _read_bgzf_block(handle)))
+            except StopIteration:
+                continue
+        handle.seek(position)
+        if not loaded:
+            return
+        self.cache_misses += len(loaded)
+        arguments = [
+            (deflated, expected_crc, expected_size, self._text)
+            for (_, (_, deflated, expected_crc, expected_size)) in loaded
+        ]
+        if self.threads > 1 and len(loaded) > 1:
+            if self._inflate_executor is None:
+                self._inflate_executor = ThreadPoolExecutor(max_workers=self.threads)
+            buffers = list(
+                self._inflate_executor.map(
+                    lambda parameters: _inflate_bgzf_block(*parameters), arguments
+                )
+            )
+        else:
+            buffers = [_inflate_bgzf_block(*parameters) for parameters in arguments]
+        for ((start_offset, (block_size, _, _, _)), buffer) in zip(loaded, buffers):
+            self._cache_block(start_offset, buffer, block_size)
+
+    def _fill_readahead(self, next_offset):
+        """Queue background loads of the blocks following the current one (PRIVATE)."""
+        queue = self._readahead_queue
+        if not queue:
+            self._readahead_state = [next_offset]
+        state = self._readahead_state
+        while len(queue) < self.readahead:
+            queue.append(self._readahead_executor.submit(self._readahead_block, state))
+
+    def _readahead_block(self, state):
+        """Read the next block of the pipeline and queue its decompression (PRIVATE).
+
+        Runs on the single readahead thread, so the queued calls walk the
+        file block after block, with state holding the next block offset.
+        """
+        start_offset = state[0]
+        if start_offset is None:
+            return None
+        handle = self._readahead_handle
+        handle.seek(start_offset)
         try:
-            block_size, self._buffer = _load_bgzf_block(handle, self._text)
+            block_size, deflated, expected_crc, expected_size = _read_bgzf_block(
+                handle
+            )
         except StopIteration:
-            # EOF
-            block_size = 0
-            if self._text:
-                self._buffer = ""
-            else:
-                self._buffer = b""
-        self._within_block_offset = 0
-        self._block_raw_length = block_size
-        # Finally save the block in our cache,
-        self._buffers[self._block_start_offset] = self._buffer, block_size
+            state[0] = None
+            return None
+        if expected_size:
+            state[0] = start_offset + block_size
+        else:
+            # Empty block (EOF marker), anything after it is not BGZF data
+            state[0] = None
+        inflated = self._inflate_executor.submit(
+            _inflate_bgzf_block, deflated, expected_crc, expected_size, self._text
+        )
+        return start_offset, block_size, inflated
+
+    def _take_readahead(self, start_offset):
+        """Return the prefetched (data, block size) of a block, or None (PRIVATE).
+
+        Blocks queued before the requested one are dropped, and if the block
+        is not in the pipeline (e.g. after a seek) the pipeline is reset.
+        Errors are left for the regular loading code to report.
+        """
+        queue = self._readahead_queue
+        while queue:
+            try:
+                loaded = queue[0].result()
+                if loaded is None or loaded[0] > start_offset:
+                    break
+                queue.popleft()
+                if loaded[0] == start_offset:
+                    return loaded[2].result(), loaded[1]
+            except Exception:
+                break
+        self._reset_readahead()
+        return None
+
+    def _reset_readahead(self):
+        """Drop all the blocks queued for readahead (PRIVATE)."""
+        for future in self._readahead_queue:
+            future.cancel()
+        self._readahead_queue.clear()
+        # Calls still running keep updating the old state object
+        self._readahead_state = [None]
+
+    def cache_info(self):
+        """Return a dictionary with the statistics of the block cache."""
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "evictions": self.cache_evictions,
+            "blocks": len(self._buffers),
+            "bytes": self._cache_bytes,
+            "cache_size": self.cache_size,
+        }
 
     def tell(self):
         """Return a 64-bit unsigned BGZF virtual offset."""
@@ -668,7 +1016,7 @@ class BgzfReader:
         if size < 0:
             raise NotImplementedError("Don't be greedy, that could be massive!")
 
-        result = "" if self._text else b""
+        chunks = []
         while size and self._buffer:
             if self._within_block_offset + size <= len(self._buffer):
                 # This may leave us right at the end of a block
@@ -678,7 +1026,9 @@ class BgzfReader:
                 ]
                 self._within_block_offset += size
                 assert data  # Must be at least 1 byte
-                result += data
+                if not chunks:
+                    return data
+                chunks.append(data)
                 break
             else:
                 data = self._buffer[self._within_block_offset :]
@@ -686,9 +1036,25 @@ class BgzfReader:
                 self._load_block()  # will reset offsets
                 # TODO - Test with corner case of an empty block followed by
                 # a non-empty block
-                result += data
+                chunks.append(data)
 
-        return result
+        return ("" if self._text else b"").join(chunks)
+
+    def read_view(self, size):
+        """Read data as a memoryview of the decompressed block if possible.
+
+        When all the data is within the current block no copy is made, the
+        returned memoryview points into the block. Otherwise (or in text
+        mode) this falls back to the read method.
+        """
+        offset = self._within_block_offset
+        if self._text or offset + size > len(self._buffer):
+            return self.read(size)
+        if self._view_source is not self._buffer:
+            self._view = memoryview(self._buffer)
+            self._view_source = self._buffer
+        self._within_block_offset = offset + size
+        return self._view[offset : offset + size]
 
     def readline(self):
         """Read a single line for the BGZF file."""
@@ -732,8 +1098,21 @@ class BgzfReader:
 
     def close(self):
         """Close BGZF file."""
+        if self._readahead_handle is not None:
+            self._reset_readahead()
+            self._readahead_executor.shutdown()
+            self._readahead_handle.close()
+            self._readahead_handle = None
+        if self._inflate_executor is not None:
+            self._inflate_executor.shutdown()
+            self._inflate_executor = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
         self._handle.close()
         self._buffer = None
+        self._view = None
+        self._view_source = None
         self._block_start_offset = None
         self._buffers = None
 
@@ -761,60 +1140,152 @@ class BgzfReader:
 class BgzfWriter:
     """Define a BGZFWriter object."""
 
-    def __init__(self, filename=None, mode="w", fileobj=None, compresslevel=6):
-        """Initilize the class."""
+    def __init__(
+        self,
+        filename=None,
+        mode="w",
+        fileobj=None,
+        compresslevel=6,
+        threads=1,
+        track_blocks=False,
+        data_end=None,
+        executor=None,
+        max_pending=None,
+    ):
+        """Initilize the class.
+
+        Use threads to compress blocks on a pool of worker threads, the
+        blocks are still written to the file in order. The default of 1
+        compresses each block on the calling thread. An executor (such as
+        a ThreadPoolExecutor) can be given instead, to share a pool between
+        several writers, it is not shut down when the file is closed.
+        At most max_pending compressed blocks (defaults to 4 per thread)
+        wait to be written, writers sharing an executor can use a smaller
+        value to bound their memory together.
+
+        With track_blocks, the file offset and the (uncompressed) data
+        offset of every block are kept, so that data offsets (as given by
+        data_tell) can later be turned into virtual offsets without
+        waiting for the compression of each block (see virtual_offset).
+
+        In append mode, the new blocks are written after the existing ones,
+        which are not modified. The existing BGZF data ends at the file
+        offset data_end (by default the end of the file), anything after it
+        is discarded, as is the EOF marker block right before it, so that
+        the file keeps a single EOF marker at its end.
+        """
+        if threads < 1:
+            raise ValueError("Use threads with a minimum of 1")
         if fileobj:
             assert filename is None
             handle = fileobj
         else:
             if "w" not in mode.lower() and "a" not in mode.lower():
                 raise ValueError("Must use write or append mode, not %r" % mode)
-            if "a" in mode.lower():
-                raise NotImplementedError("Append mode is not implemented yet")
-                # handle = _open(filename, "ab")
+            if "a" in mode.lower() and os.path.exists(filename):
+                handle = _open(filename, "r+b")
             else:
                 handle = _open(filename, "wb")
+        if "a" in mode.lower():
+            if data_end is None:
+                handle.seek(0, os.SEEK_END)
+                data_end = handle.tell()
+            if data_end >= len(_bgzf_eof):
+                handle.seek(data_end - len(_bgzf_eof))
+                if handle.read(len(_bgzf_eof)) == _bgzf_eof:
+                    data_end -= len(_bgzf_eof)
+            handle.seek(data_end)
+            handle.truncate()
         self._text = "b" not in mode.lower()
         self._handle = handle
         self._buffer = b""
         self.compresslevel = compresslevel
+        self.threads = threads
+        self._pending = deque()
+        self._max_pending = 4 * threads if max_pending is None else max(1, max_pending)
+        self._data_offset = 0
+        if track_blocks:
+            self.block_offsets = array("Q")
+            self.block_data_offsets = array("Q")
+        else:
+            self.block_offsets = None
+            self.block_data_offsets = None
+        self._owns_executor = executor is None
+        if executor is not None:
+            self._executor = executor
+        elif threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+        else:
+            self._executor = None
 
     def _write_block(self, block):
-        """Write provided data to file as a single BGZF compressed block (PRIVATE)."""
+        """Write provided data to file as a single BGZF compressed block (PRIVATE).
+
+        With a worker pool the block is compressed in the background and
+        only written once all the blocks queued before it are on disk.
+        """
         # print("Saving %i bytes" % len(block))
-        start_offset = self._handle.tell()
         assert len(block) <= 65536
-        # Giving a negative window bits means no gzip/zlib headers,
-        # -15 used in samtools
-        c = zlib.compressobj(
-            self.compresslevel, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, 0
-        )
-        compressed = c.compress(block) + c.flush()
-        del c
-        if len(compressed) > 65536:
-            raise RuntimeError(
-                "TODO - Didn't compress enough, try less data in this block"
+        data_start = self._data_offset
+        self._data_offset += len(block)
+        if self._executor is None:
+            self._write_compressed(
+                _compress_bgzf_block(block, self.compresslevel), data_start
             )
-        crc = zlib.crc32(block)
-        # Should cope with a mix of Python platforms...
-        if crc < 0:
-            crc = struct.pack("<i", crc)
-        else:
-            crc = struct.pack("<I", crc)
-        bsize = struct.pack("<H", len(compressed) + 25)  # includes -1
-        crc = struct.pack("<I", zlib.crc32(block) & 0xFFFFFFFF)
-        uncompressed_length = struct.pack("<I", len(block))
-        # Fixed 16 bytes,
-        # gzip magic bytes (4) mod time (4),
-        # gzip flag (1), os (1), extra length which is six (2),
-        # sub field which is BC (2), sub field length of two (2),
-        # Variable data,
-        # 2 bytes: block length as BC sub field (2)
-        # X bytes: the data
-        # 8 bytes: crc (4), uncompressed data length (4)
-        data = _bgzf_header + bsize + compressed + crc + uncompressed_length
+            return
+        self._pending.append(
+            (
+                self._executor.submit(
+                    _compress_bgzf_block, block, self.compresslevel
+                ),
+                data_start,
+            )
+        )
+        while len(self._pending) > self._max_pending or (
+            self._pending and self._pending[0][0].done()
+        ):
+            future, data_start = self._pending.popleft()
+            self._write_compressed(future.result(), data_start)
+
+    def _write_pending(self):
+        """Wait for the queued blocks and write them in order (PRIVATE)."""
+        while self._pending:
+            future, data_start = self._pending.popleft()
+            self._write_compressed(future.result(), data_start)
+
+    def _write_compressed(self, data, data_start):
+        """Write a compressed block, keeping track of its offsets (PRIVATE)."""
+        if self.block_offsets is not None:
+            self.block_offsets.append(self._handle.tell())
+            self.block_data_offsets.append(data_start)
         self._handle.write(data)
 
+    def data_tell(self):
+        """Return the offset of the next byte in the uncompressed data.
+
+        Unlike tell, this does not need to wait for pending blocks.
+        """
+        return self._data_offset + len(self._buffer)
+
+    def virtual_offset(self, data_offset):
+        """Return the virtual offset of an offset in the uncompressed data.
+
+        Requires track_blocks, and the data must already be in a block
+        (e.g. after end_block), waiting for any pending block first.
+        """
+        if self.block_offsets is None:
+            raise ValueError("Requires a BgzfWriter with track_blocks=True")
+        self._write_pending()
+        index = bisect_right(self.block_data_offsets, data_offset) - 1
+        if index < 0 or data_offset > self._data_offset:
+            raise ValueError("Data offset %i not in a block yet" % data_offset)
+        if data_offset == self._data_offset:
+            # Right at the end of the written data, i.e. the next block
+            return self._handle.tell() << 16
+        return make_virtual_offset(
+            self.block_offsets[index], data_offset - self.block_data_offsets[index]
+        )
+
     def write(self, data):
         """Write method for the class."""
         # TODO - Check bytes vs unicode
@@ -837,6 +1308,19 @@ class BgzfWriter:
                 self._write_block(self._buffer[:65536])
                 self._buffer = self._buffer[65536:]
 
+    def end_block(self):
+        """Write any buffered data as a BGZF block of its own.
+
+        The data written next will start a new block. Unlike flush, this
+        does not write an empty block when there is nothing buffered.
+        """
+        while len(self._buffer) >= 65536:
+            self._write_block(self._buffer[:65536])
+            self._buffer = self._buffer[65536:]
+        if self._buffer:
+            self._write_block(self._buffer)
+            self._buffer = b""
+
     def flush(self):
         """Flush data explicitally."""
         while len(self._buffer) >= 65536:
@@ -844,6 +1328,7 @@ class BgzfWriter:
             self._buffer = self._buffer[65535:]
         self._write_block(self._buffer)
         self._buffer = b""
+        self._write_pending()
         self._handle.flush()
 
     def close(self,extraData=None):
@@ -858,6 +1343,10 @@ class BgzfWriter:
         """
         if self._buffer:
             self.flush()
+        self._write_pending()
+        if self._executor is not None and self._owns_executor:
+            self._executor.shutdown()
+        self._executor = None
         self._handle.write(_bgzf_eof)
         self._handle.flush()
         if(extraData):
@@ -866,7 +1355,12 @@ class BgzfWriter:
         self._handle.close()
 
     def tell(self):
-        """Return a BGZF 64-bit virtual offset."""
+        """Return a BGZF 64-bit virtual offset.
+
+        The compressed size of queued blocks is only known once they are
+        done, so this waits for any pending blocks to be written first.
+        """
+        self._write_pending()
         return make_virtual_offset(self._handle.tell(), len(self._buffer))
 
     def seekable(self):
@@ -1,12 +1,33 @@
 
 from .bgzf import BgzfWriter
 from .bgzf import BgzfReader
+from .bgzf import BgzfBlockStarts
+from .index import SortedIndexWriter
+from .index import InvertedIndexWriter
+from .index import _schemeKeyTypes
+from .index import _writeRunFile
 import struct
 import os
+import sys
+import multiprocessing
 import msgpack
+import hashlib
+import math
+import operator
+from array import array
+from bisect import bisect_left
+from bisect import bisect_right
 
 # _sizeStructCache = {}
 
+# Largest amount of (uncompressed) data in a BGZF block
+_blockSize = 65536
+
+# Files with metadata end with: metadata (msgpack), its size, this magic
+# and the entries count. Older files only have the entries count after the
+# EOF block, which is all that older readers look at.
+_metadataMagic = b"DBGZMETA"
+
 
 def _calcSize(format):
     structSize = struct.calcsize(format)
@@ -20,10 +41,12 @@ def any2Data(anyObject):
     return data
 
 
+# The decoders use struct.unpack_from on data, which can be bytes or a
+# memoryview of a decompressed block, to avoid copying each field.
+
 def data2Any(data, currentPointer):
     pointerSize = _calcSize("<Q")
-    dataLength, = struct.unpack(
-        "<Q", data[currentPointer:currentPointer+pointerSize])
+    dataLength, = struct.unpack_from("<Q", data, currentPointer)
     if dataLength == 0:
         # print("data length is 0")
         return (None, currentPointer+pointerSize)
@@ -46,11 +69,10 @@ def string2Data(text):
 
 def data2String(data, currentPointer):
     pointerSize = _calcSize("<Q")
-    stringLength, = struct.unpack(
-        "<Q", data[currentPointer:currentPointer+pointerSize])
+    stringLength, = struct.unpack_from("<Q", data, currentPointer)
     return (
-        data[currentPointer+pointerSize:currentPointer +
-             pointerSize+stringLength].decode("utf8"),
+        str(data[currentPointer+pointerSize:currentPointer +
+                 pointerSize+stringLength], "utf8"),
         currentPointer+stringLength+pointerSize)
 
 
@@ -64,19 +86,17 @@ def intArray2Data(values):
 
 def data2Int(data, currentPointer):
     pointerSize = _calcSize("<q")
-    value, = struct.unpack(
-        "<q", data[currentPointer:currentPointer+pointerSize])
+    value, = struct.unpack_from("<q", data, currentPointer)
     return (value, currentPointer+pointerSize)
 
 
 def data2IntArray(data, currentPointer):
     offset = _calcSize("<Q")
-    count, = struct.unpack("<Q", data[currentPointer:currentPointer+offset])
+    count, = struct.unpack_from("<Q", data, currentPointer)
     pointerSize = count*_calcSize("<q")
     values = ()
     if (count):
-        values = struct.unpack("<%uq" % count, data[(
-            currentPointer+offset):(currentPointer+offset+pointerSize)])
+        values = struct.unpack_from("<%uq" % count, data, currentPointer+offset)
     return (values, currentPointer+offset+pointerSize)
 
 
@@ -90,19 +110,17 @@ def uintArray2Data(values):
 
 def data2UInt(data, currentPointer):
     pointerSize = _calcSize("<Q")
-    value, = struct.unpack(
-        "<Q", data[currentPointer:currentPointer+pointerSize])
+    value, = struct.unpack_from("<Q", data, currentPointer)
     return (value, currentPointer+pointerSize)
 
 
 def data2UIntArray(data, currentPointer):
     offset = _calcSize("<Q")
-    count, = struct.unpack("<Q", data[currentPointer:currentPointer+offset])
+    count, = struct.unpack_from("<Q", data, currentPointer)
     pointerSize = count*_calcSize("<Q")
     values = ()
     if (count):
-        values = struct.unpack("<%uQ" % count, data[(
-            currentPointer+offset):(currentPointer+offset+pointerSize)])
+        values = struct.unpack_from("<%uQ" % count, data, currentPointer+offset)
     return (values, currentPointer+offset+pointerSize)
 
 
@@ -116,19 +134,17 @@ def doubleArray2Data(values):
 
 def data2Double(data, currentPointer):
     pointerSize = _calcSize("<d")
-    value, = struct.unpack(
-        "<d", data[currentPointer:currentPointer+pointerSize])
+    value, = struct.unpack_from("<d", data, currentPointer)
     return (value, currentPointer+pointerSize)
 
 
 def data2DoubleArray(data, currentPointer):
     offset = _calcSize("<Q")
-    count, = struct.unpack("<Q", data[currentPointer:currentPointer+offset])
+    count, = struct.unpack_from("<Q", data, currentPointer)
     pointerSize = count*_calcSize("<d")
     values = ()
     if (count):
-        values = struct.unpack("<%ud" % count, data[(
-            currentPointer+offset):(currentPointer+offset+pointerSize)])
+        values = struct.unpack_from("<%ud" % count, data, currentPointer+offset)
     return (values, currentPointer+offset+pointerSize)
 
 
@@ -142,19 +158,17 @@ def floatArray2Data(values):
 
 def data2Float(data, currentPointer):
     pointerSize = _calcSize("<f")
-    value, = struct.unpack(
-        "<f", data[currentPointer:currentPointer+pointerSize])
+    value, = struct.unpack_from("<f", data, currentPointer)
     return (value, currentPointer+pointerSize)
 
 
 def data2FloatArray(data, currentPointer):
     offset = _calcSize("<Q")
-    count, = struct.unpack("<Q", data[currentPointer:currentPointer+offset])
+    count, = struct.unpack_from("<Q", data, currentPointer)
     pointerSize = count*_calcSize("<f")
     values = ()
     if (count):
-        values = struct.unpack("<%uf" % count, data[(
-            currentPointer+offset):(currentPointer+offset+pointerSize)])
+        values = struct.unpack_from("<%uf" % count, data, currentPointer+offset)
     return (values, currentPointer+offset+pointerSize)
 
 
@@ -167,7 +181,7 @@ def stringArray2Data(textArray):
 
 def data2StringArray(data, currentPointer):
     offset = _calcSize("<Q")
-    count, = struct.unpack("<Q", data[currentPointer:currentPointer+offset])
+    count, = struct.unpack_from("<Q", data, currentPointer)
     values = []
     pointerSize = 0
     currentPointer += offset
@@ -178,6 +192,58 @@ def data2StringArray(data, currentPointer):
     return (tuple(values), currentPointer)
 
 
+def _packTrailer(entriesCount, metadata=None):
+    trailer = b""
+    if (metadata):
+        metadataData = msgpack.packb(metadata, use_bin_type=True)
+        trailer = metadataData+struct.pack("<Q", len(metadataData))+_metadataMagic
+    return trailer+struct.pack("<Q", entriesCount)
+
+
+def _readTrailer(handle):
+    """
+    Reads the entries count and metadata stored after the EOF block
+    of a DBGZ file from a raw (binary) handle.
+    Returns a tuple (entriesCount, metadata).
+    """
+    startPoint = handle.tell()
+    pointerSize = _calcSize("<Q")
+    handle.seek(0, os.SEEK_END)
+    fileSize = handle.tell()
+    metadata = {}
+    if (fileSize >= 3*pointerSize):
+        handle.seek(-3*pointerSize, os.SEEK_END)
+        metadataSize, magic, entriesCount = struct.unpack(
+            "<Q8sQ", handle.read(3*pointerSize))
+        if (magic == _metadataMagic):
+            handle.seek(-3*pointerSize-metadataSize, os.SEEK_END)
+            metadata = msgpack.unpackb(
+                handle.read(metadataSize), raw=False, strict_map_key=False)
+    else:
+        handle.seek(-pointerSize, os.SEEK_END)
+        entriesCount, = struct.unpack("<Q", handle.read(pointerSize))
+    handle.seek(startPoint)
+    return (entriesCount, metadata)
+
+
+def _trailerOffset(handle):
+    """
+    Returns the file offset at which the trailer (after the EOF block)
+    of a DBGZ file starts, from a raw (binary) handle.
+    """
+    startPoint = handle.tell()
+    pointerSize = _calcSize("<Q")
+    handle.seek(0, os.SEEK_END)
+    offset = handle.tell()-pointerSize
+    if (offset >= 2*pointerSize):
+        handle.seek(offset-2*pointerSize)
+        metadataSize, magic = struct.unpack("<Q8s", handle.read(2*pointerSize))
+        if (magic == _metadataMagic):
+            offset -= 2*pointerSize+metadataSize
+    handle.seek(startPoint)
+    return offset
+
+
 # default,encode,decode
 _typesDictionary = {
     "i": (0, int2Data, data2Int),
@@ -195,14 +261,304 @@ _typesDictionary = {
     "a": (None, any2Data, data2Any),
 }
 
+# struct codes of the fixed width types and of the items of the array types
+_fixedTypesFormats = {"i": "q", "u": "Q", "f": "f", "d": "d"}
+_arrayTypesFormats = {"I": "q", "U": "Q", "F": "f", "D": "d"}
+
+
+def _codecNamespace():
+    namespace = {
+        "_pack": struct.pack,
+        "_unpack_from": struct.unpack_from,
+        "_sizeStruct": struct.Struct("<Q"),
+    }
+    for typeType, (default, encode, decode) in _typesDictionary.items():
+        namespace["_default_"+typeType] = default
+        namespace["_encode_"+typeType] = encode
+        namespace["_decode_"+typeType] = decode
+    return namespace
+
+
+def _groupScheme(scheme):
+    # Groups consecutive fixed width properties, as (type, indices) pairs
+    groups = []
+    for (index, (typeName, typeType)) in enumerate(scheme):
+        if (typeType in _fixedTypesFormats):
+            if (groups and groups[-1][0] == "fixed"):
+                groups[-1][1].append(index)
+                continue
+            groups.append(("fixed", [index]))
+        else:
+            groups.append((typeType, [index]))
+    return groups
+
+
+def _compileFunctions(namespace, *functionsLines):
+    functions = []
+    for lines in functionsLines:
+        localNamespace = {}
+        exec("\n".join(lines), namespace, localNamespace)
+        functions.append(next(iter(localNamespace.values())))
+    return tuple(functions)
+
+
+def _compileCodec(scheme):
+    """
+    Generates the functions encoding and decoding entries of a scheme.
+
+    Consecutive fixed width properties are packed and unpacked together
+    with a single struct.Struct, while strings and numeric arrays are
+    handled inline, so that no per property function call is needed.
+    Returns a tuple (encode, decodeAsList, decodeAsDict), where encode
+    takes the list of values (None for defaults) and returns the entry
+    data including its size, and the decoders take the entry data.
+    """
+    namespace = _codecNamespace()
+    encodeLines = ["def encode(values):"]
+    parts = []
+    for (groupIndex, (groupType, indices)) in enumerate(_groupScheme(scheme)):
+        for index in indices:
+            typeType = scheme[index][1]
+            encodeLines.append("    v%d = values[%d]" % (index, index))
+            encodeLines.append("    if v%d is None:" % index)
+            encodeLines.append("        v%d = _default_%s" % (index, typeType))
+        variables = ", ".join("v%d" % index for index in indices)
+        if (groupType == "fixed"):
+            structName = "_struct%d" % groupIndex
+            namespace[structName] = struct.Struct(
+                "<"+"".join(_fixedTypesFormats[scheme[index][1]] for index in indices))
+            parts.append("%s.pack(%s)" % (structName, variables))
+        else:
+            parts.append("_encode_%s(%s)" % (groupType, variables))
+    encodeLines.append("    entryData = b''.join((%s,))" % ", ".join(parts))
+    encodeLines.append("    return _sizeStruct.pack(len(entryData))+entryData")
+    if (not scheme):
+        encodeLines = ["def encode(values):", "    return _sizeStruct.pack(0)"]
+    encode, = _compileFunctions(namespace, encodeLines)
+    return (encode,)+_compileDecoders(scheme)
+
+
+def _compileDecoders(scheme, fields=None):
+    """
+    Generates the functions decoding entries of a scheme (see _compileCodec).
+
+    If fields is given, only these properties are decoded, in that order.
+    The other properties are skipped using their sizes and decoding stops
+    after the last requested property.
+    Returns a tuple (decodeAsList, decodeAsDict).
+    """
+    namespace = _codecNamespace()
+    if (fields is None):
+        fields = [typeName for (typeName, _) in scheme]
+    name2Index = {typeName: index for (index, (typeName, _)) in enumerate(scheme)}
+    requested = set(name2Index[field] for field in fields)
+    lastIndex = max(requested) if requested else -1
+    decodeLines = ["def decode(data):", "    p = 0"]
+    for (groupIndex, (groupType, indices)) in enumerate(_groupScheme(scheme)):
+        if (indices[0] > lastIndex):
+            break
+        if (groupType == "fixed"):
+            # Skipped properties become pad bytes of the struct
+            structName = "_struct%d" % groupIndex
+            formats = []
+            variables = []
+            for index in indices:
+                itemFormat = _fixedTypesFormats[scheme[index][1]]
+                if (index in requested):
+                    formats.append(itemFormat)
+                    variables.append("v%d" % index)
+                else:
+                    formats.append("%dx" % _calcSize("<"+itemFormat))
+            namespace[structName] = struct.Struct("<"+"".join(formats))
+            if (variables):
+                decodeLines.append("    %s, = %s.unpack_from(data, p)" % (", ".join(variables), structName))
+            decodeLines.append("    p += %d" % namespace[structName].size)
+            continue
+        index = indices[0]
+        variable = "v%d" % index
+        if (groupType == "S"):
+            if (index in requested):
+                decodeLines.append("    %s, p = _decode_S(data, p)" % variable)
+            else:
+                decodeLines.append("    n, = _sizeStruct.unpack_from(data, p)")
+                decodeLines.append("    p += 8")
+                decodeLines.append("    for _ in range(n):")
+                decodeLines.append("        p += 8+_sizeStruct.unpack_from(data, p)[0]")
+            continue
+        # The other types start with their size (or number of items)
+        decodeLines.append("    n, = _sizeStruct.unpack_from(data, p)")
+        decodeLines.append("    p += 8")
+        if (groupType in _arrayTypesFormats):
+            itemFormat = _arrayTypesFormats[groupType]
+            if (index in requested):
+                decodeLines.append(
+                    "    %s = _unpack_from('<%%u%s' %% n, data, p) if n else ()" % (variable, itemFormat))
+            decodeLines.append("    p += %d*n" % _calcSize("<"+itemFormat))
+        else:
+            if (index in requested):
+                if (groupType == "s"):
+                    decodeLines.append("    %s = str(data[p:p+n], 'utf8')" % variable)
+                else:
+                    decodeLines.append("    %s, _ = _decode_%s(data, p-8)" % (variable, groupType))
+            decodeLines.append("    p += n")
+    decodeListLines = decodeLines+["    return [%s]" % ", ".join(
+        "v%d" % name2Index[field] for field in fields)]
+    decodeDictLines = decodeLines+["    return {%s}" % ", ".join(
+        "%r: v%d" % (field, name2Index[field]) for field in fields)]
+    return _compileFunctions(namespace, decodeListLines, decodeDictLines)
+
 
 class DBGZWriter():
-    def __init__(self, filename, scheme, *args, **kwargs):
+    def __init__(self, filename, scheme, *args, mode="w", alignedBlocks=False, zoneMaps=None,
+                 ordinalIndex=None, bloomFilters=None, bloomFilterBlocks=1,
+                 bloomFilterRate=0.01, sortKey=None, **kwargs):
+        """
+        Creates a DBGZ file with the given scheme.
+
+        Parameters
+        ----------
+        filename : str
+          Path of the file to be written.
+        scheme : list of (str, str)
+          Pairs of property name and type.
+        mode : str
+          "w" to create the file, or "a" to add entries to the end of an
+          existing file, which must have the same scheme. Its compressed
+          blocks are kept as they are, only the entries count and metadata
+          after them are written again. The alignedBlocks, zoneMaps,
+          ordinalIndex, bloomFilters and sortKey settings of the file are
+          kept for the new entries (and can't be changed).
+          (defaults to "w")
+        alignedBlocks : bool
+          If True, every BGZF block starts at the beginning of an entry,
+          so that blocks can be decoded independently (see
+          DBGZReader.readBlock). Entries larger than a block get blocks
+          of their own. This is recorded in the file metadata.
+          (defaults to False)
+        zoneMaps : list of str
+          Numeric (i, u, f, d) properties for which the minimum, maximum
+          and number of missing values (None or NaN) are kept for the
+          entries starting in each block (zone). These are stored in the
+          file metadata and used by DBGZReader.scan to skip whole zones.
+          (optional)
+        ordinalIndex : int
+          If given, the position of every ordinalIndex-th entry is stored in
+          the file metadata, so that DBGZReader can get to any entry by its
+          number (e.g. fd[i] or fd[a:b]) by decoding at most ordinalIndex-1
+          entries before it.
+          (optional)
+        bloomFilters : list of str
+          Integer or string properties (i, u, s, or arrays I, U, S, for
+          which each element is a key) for which a Bloom filter of the
+          values of the entries starting in each group of blocks is stored
+          in the file metadata. DBGZReader.candidateBlocks and scan (for ==
+          and in conditions) use them to skip groups without a key.
+          (optional)
+        bloomFilterBlocks : int
+          Number of blocks in each group with a Bloom filter.
+          (defaults to 1)
+        bloomFilterRate : float
+          Target false positive rate of the Bloom filters.
+          (defaults to 0.01)
+        sortKey : str
+          Property (i, u, f, d or s) by which the entries are written in
+          (non-decreasing) order. The order is verified as entries are
+          written, and the key of the first entry starting in each block is
+          stored in the file metadata, so that DBGZReader.seekKey and
+          rangeScan can find keys with a binary search over the blocks.
+          (optional)
+        Other arguments are passed to BgzfWriter (e.g. threads).
+        """
+        if (mode not in ("w", "a")):
+            raise Exception("Invalid mode '"+str(mode)+"', use 'w' or 'a'")
+        appending = (mode == "a" and os.path.exists(filename)
+                     and os.path.getsize(filename) > 0)
+        metadata = {}
+        entriesCount = 0
+        dataEnd = None
+        if (appending):
+            with DBGZReader(filename) as reader:
+                if ([tuple(field) for field in reader.scheme] != [tuple(field) for field in scheme]):
+                    raise Exception("The scheme does not match the scheme of "+str(filename))
+                entriesCount = reader.entriesCount
+                metadata = reader.metadata
+                dataEnd = _trailerOffset(reader.fd._handle)
+            if (alignedBlocks and not metadata.get("alignedBlocks", False)):
+                raise Exception("Can't append with alignedBlocks to a file without them")
+            alignedBlocks = metadata.get("alignedBlocks", False)
+            existingFields = {
+                "zoneMaps": metadata.get("zoneMaps", {}).get("fields"),
+                "bloomFilters": metadata.get("bloomFilters", {}).get("fields"),
+                "ordinalIndex": metadata.get("ordinalIndex", {}).get("every"),
+                "sortKey": metadata.get("sortKey", {}).get("field"),
+            }
+            for (name, value) in (("zoneMaps", zoneMaps), ("bloomFilters", bloomFilters),
+                                  ("ordinalIndex", ordinalIndex), ("sortKey", sortKey)):
+                if (isinstance(value, (list, tuple))):
+                    value = list(value)
+                if (value and value != existingFields[name]):
+                    raise Exception("Can't append with different "+name+" than those of the file")
+            zoneMaps = existingFields["zoneMaps"]
+            bloomFilters = existingFields["bloomFilters"]
+            ordinalIndex = existingFields["ordinalIndex"]
+            sortKey = existingFields["sortKey"]
         self.scheme = scheme
-        self.fd = BgzfWriter(filename, mode="wb", *args, **kwargs)
-        self.writeScheme()
+        self.zoneMaps = list(zoneMaps) if zoneMaps else []
+        self.ordinalIndex = ordinalIndex
+        if (ordinalIndex is not None and ordinalIndex < 1):
+            raise Exception("ordinalIndex must be at least 1")
+        self.bloomFilters = list(bloomFilters) if bloomFilters else []
+        self.bloomFilterBlocks = bloomFilterBlocks
+        self.bloomFilterRate = bloomFilterRate
+        if (bloomFilterBlocks < 1):
+            raise Exception("bloomFilterBlocks must be at least 1")
+        if (not 0 < bloomFilterRate < 1):
+            raise Exception("bloomFilterRate must be between 0 and 1")
+        self.sortKey = sortKey
+        trackBlocks = bool(self.zoneMaps or ordinalIndex or self.bloomFilters or sortKey)
+        self.fd = BgzfWriter(filename, mode="ab" if appending else "wb", *args,
+                             track_blocks=trackBlocks, data_end=dataEnd, **kwargs)
+        self.metadata = metadata
+        self.alignedBlocks = alignedBlocks
+        if (appending):
+            self._compileScheme()
+        else:
+            self.writeScheme()
         self.aggregatedData = b''
-        self.totalEntries = 0
+        self.alignedData = []
+        self.alignedSize = 0
+        self.totalEntries = entriesCount
+        self._zones = []
+        self._zoneIndices = []
+        self._ordinalOffsets = []
+        self._bloomGroups = []
+        self._bloomIndices = []
+        for name in self.bloomFilters:
+            if (name not in self.name2Index):
+                raise Exception("Property '"+name+"' not found in the scheme")
+            if (self.scheme[self.name2Index[name]][1] not in _bloomTypes):
+                raise Exception("Bloom filters are only supported for i, u, s, I, U and S properties")
+            self._bloomIndices.append(self.name2Index[name])
+        for name in self.zoneMaps:
+            if (name not in self.name2Index):
+                raise Exception("Property '"+name+"' not found in the scheme")
+            if (self.scheme[self.name2Index[name]][1] not in _fixedTypesFormats):
+                raise Exception("Zone maps are only supported for i, u, f and d properties")
+            self._zoneIndices.append(self.name2Index[name])
+        self._sortKeyIndex = None
+        self._sortKeyBlocks = []
+        self._lastSortKey = metadata.get("sortKey", {}).get("last")
+        if (sortKey):
+            if (sortKey not in self.name2Index):
+                raise Exception("Property '"+sortKey+"' not found in the scheme")
+            if (self.scheme[self.name2Index[sortKey]][1] not in ("i", "u", "f", "d", "s")):
+                raise Exception("The sort key must be an i, u, f, d or s property")
+            self._sortKeyIndex = self.name2Index[sortKey]
+            self._sortKeyDecoder = _compileDecoders(self.scheme, [sortKey])[0]
+        if (alignedBlocks and not appending):
+            self.metadata["alignedBlocks"] = True
+            # Entries start right after the scheme block
+            self.fd.end_block()
 
     def __enter__(self):
         # ttysetattr etc goes here before opening and returning the file object
@@ -214,29 +570,288 @@ class DBGZWriter():
 
     def close(self):
         self._aggregatedUpdate(True)
-        self.fd.close(extraData=struct.pack("<Q", self.totalEntries))
+        # Positions are only known once the data is in blocks
+        self.fd.end_block()
+        # (when appending, the metadata already has those of the previous entries)
+        if (self.ordinalIndex):
+            positions = array("Q", [self.fd.virtual_offset(dataOffset)
+                                    for dataOffset in self._ordinalOffsets])
+            if (sys.byteorder == "big"):
+                positions.byteswap()
+            previous = self.metadata.get("ordinalIndex", {}).get("positions", b"")
+            self.metadata["ordinalIndex"] = {
+                "every": self.ordinalIndex,
+                "positions": previous+positions.tobytes(),
+            }
+        if (self.bloomFilters):
+            self._finishBloomGroup()
+            previous = self.metadata.get("bloomFilters", {}).get("groups", [])
+            self.metadata["bloomFilters"] = {
+                "fields": self.bloomFilters,
+                "groups": previous+[[self.fd.virtual_offset(dataOffset), count, filters]
+                                    for (dataOffset, count, filters) in self._bloomGroups],
+            }
+        if (self.zoneMaps):
+            previous = self.metadata.get("zoneMaps", {}).get("zones", [])
+            self.metadata["zoneMaps"] = {
+                "fields": self.zoneMaps,
+                "zones": previous+[[self.fd.virtual_offset(dataOffset), count, statistics]
+                                   for (dataOffset, count, statistics) in self._zones],
+            }
+        if (self.sortKey):
+            previous = self.metadata.get("sortKey", {}).get("blocks", [])
+            self.metadata["sortKey"] = {
+                "field": self.sortKey,
+                "blocks": previous+[[self.fd.virtual_offset(dataOffset), key]
+                                    for (dataOffset, key) in self._sortKeyBlocks],
+                "last": self._lastSortKey,
+            }
+        self.fd.close(extraData=_packTrailer(self.totalEntries, self.metadata))
 
     def write(self, **kargs):
-        data = b''
-        values = [entry[0] for entry in self.index2Type]
-        for index, name in enumerate(self.index2Name):
-            if (name in kargs):
-                values[index] = kargs[name]
+        values = [kargs.get(name) for name in self.index2Name]
         self.writeFromArray(values)
 
     def writeFromArray(self, values):
-        entryData = b""
-        for (index, (default, encode, decode)) in enumerate(self.index2Type):
-            currentValue = values[index]
-            if (currentValue is None):
-                currentValue = default
-            entryData += encode(currentValue)
+        if (self._sortKeyIndex is not None):
+            sortKey = self._checkSortKeys([values[self._sortKeyIndex]])[0]
+        self.totalEntries += 1
+        finalData = self._encode(values)
+        dataOffset = self._writeEntryData(finalData)
+        if (self._sortKeyIndex is not None):
+            self._addSortKeyBlock(dataOffset, sortKey)
+        if (self._zoneIndices):
+            self._updateZones(dataOffset, values)
+        if (self._bloomIndices):
+            self._updateBloomFilters(dataOffset, [values[index] for index in self._bloomIndices])
+        if (self.ordinalIndex and (self.totalEntries-1) % self.ordinalIndex == 0):
+            self._ordinalOffsets.append(dataOffset)
+
+    def writeEncoded(self, entryData):
+        """
+        Writes an entry already encoded, with its size, in the format of the
+        scheme (e.g. read from a file with the same scheme with
+        DBGZReader.readEncoded), without decoding and encoding it again.
+        """
+        data = memoryview(entryData)[_calcSize("<Q"):]
+        values = None
+        if (self._zoneIndices or self._bloomIndices):
+            values = self._decodeAsList(data)
+        if (self._sortKeyIndex is not None):
+            if (values is None):
+                sortKey = self._sortKeyDecoder(data)[0]
+            else:
+                sortKey = values[self._sortKeyIndex]
+            sortKey = self._checkSortKeys([sortKey])[0]
         self.totalEntries += 1
-        finalData = (struct.pack("<Q", len(entryData))+entryData)
-        self.aggregatedData += finalData
+        dataOffset = self._writeEntryData(entryData)
+        if (self._sortKeyIndex is not None):
+            self._addSortKeyBlock(dataOffset, sortKey)
+        if (values is not None):
+            if (self._zoneIndices):
+                self._updateZones(dataOffset, values)
+            if (self._bloomIndices):
+                self._updateBloomFilters(dataOffset, [values[index] for index in self._bloomIndices])
+        if (self.ordinalIndex and (self.totalEntries-1) % self.ordinalIndex == 0):
+            self._ordinalOffsets.append(dataOffset)
+
+    def _writeEntryData(self, entryData):
+        # Returns the offset of the entry in the uncompressed data
+        if (self.alignedBlocks):
+            return self._alignedUpdate(entryData)
+        dataOffset = self.fd.data_tell()+len(self.aggregatedData)
+        self.aggregatedData += entryData
         self._aggregatedUpdate()
+        return dataOffset
+
+    def _checkSortKeys(self, keys):
+        # Keys (as stored) of the next entries, raises if they are out of order
+        typeType = self.scheme[self._sortKeyIndex][1]
+        default = _typesDictionary[typeType][0]
+        keys = [default if key is None else key for key in keys]
+        if (typeType == "f"):
+            # Same rounding as the stored value
+            keys = list(struct.unpack("<%df" % len(keys), struct.pack("<%df" % len(keys), *keys)))
+        elif (typeType == "d"):
+            keys = [float(key) for key in keys]
+        elif (typeType != "s"):
+            keys = [int(key) for key in keys]
+        if (self._lastSortKey is not None):
+            keys.insert(0, self._lastSortKey)
+        if (any(key != key for key in keys) or not all(map(operator.le, keys, keys[1:]))):
+            raise Exception("Entries are not sorted by '"+self.sortKey+"'")
+        if (self._lastSortKey is not None):
+            keys.pop(0)
+        if (keys):
+            self._lastSortKey = keys[-1]
+        return keys
+
+    def _addSortKeyBlock(self, dataOffset, key):
+        # Keeps the key of the first entry starting in each block
+        blocks = self._sortKeyBlocks
+        if (not blocks or blocks[-1][0]//_blockSize != dataOffset//_blockSize):
+            blocks.append([dataOffset, key])
+
+    def _zoneFor(self, dataOffset):
+        # Zone of the entries starting in the same block as dataOffset
+        zones = self._zones
+        if (not zones or zones[-1][0]//_blockSize != dataOffset//_blockSize):
+            zones.append([dataOffset, 0, [[None, None, 0] for _ in self._zoneIndices]])
+        return zones[-1]
+
+    def _updateZones(self, dataOffset, values):
+        zone = self._zoneFor(dataOffset)
+        zone[1] += 1
+        for (statistics, index) in zip(zone[2], self._zoneIndices):
+            value = values[index]
+            typeType = self.scheme[index][1]
+            if (typeType == "f" or typeType == "d"):
+                # Missing values are stored as NaN
+                if (value is None or value != value):
+                    statistics[2] += 1
+                    continue
+                if (typeType == "f"):
+                    # Same rounding as the stored value
+                    value, = struct.unpack("<f", struct.pack("<f", value))
+                value = float(value)
+            else:
+                if (value is None):
+                    statistics[2] += 1
+                    value = _typesDictionary[typeType][0]
+                value = int(value)
+            _mergeZoneStatistics(statistics, value, value, 0)
+
+    def _updateZonesColumns(self, np, dataOffsets, columns):
+        # Same as _updateZones for a batch of entries given as columns
+        if (not len(dataOffsets)):
+            return
+        blocks = dataOffsets//_blockSize
+        starts = np.concatenate(([0], np.flatnonzero(blocks[1:] != blocks[:-1])+1))
+        ends = np.append(starts[1:], len(dataOffsets))
+        fieldsStatistics = []
+        for index in self._zoneIndices:
+            typeName, typeType = self.scheme[index]
+            dtype = np.dtype(_numpyTypes[typeType])
+            if (typeName in columns):
+                values = np.asarray(columns[typeName]).astype(dtype)
+                nulls = np.zeros(len(values), dtype=np.int64)
+            else:
+                values = np.full(len(dataOffsets), _typesDictionary[typeType][0], dtype=dtype)
+                nulls = np.ones(len(values), dtype=np.int64)
+            if (typeType == "f" or typeType == "d"):
+                values = values.astype(np.float64)
+                nulls = np.isnan(values).astype(np.int64)
+                minimums = np.fmin.reduceat(values, starts)
+                maximums = np.fmax.reduceat(values, starts)
+            else:
+                minimums = np.minimum.reduceat(values, starts)
+                maximums = np.maximum.reduceat(values, starts)
+            fieldsStatistics.append((minimums.tolist(), maximums.tolist(),
+                                     np.add.reduceat(nulls, starts).tolist()))
+        for (segment, (start, end)) in enumerate(zip(starts.tolist(), ends.tolist())):
+            zone = self._zoneFor(int(dataOffsets[start]))
+            zone[1] += end-start
+            for (statistics, (minimums, maximums, nulls)) in zip(zone[2], fieldsStatistics):
+                minimum, maximum = minimums[segment], maximums[segment]
+                if (minimum != minimum):
+                    minimum, maximum = None, None
+                _mergeZoneStatistics(statistics, minimum, maximum, nulls[segment])
+
+    def _finishBloomGroup(self):
+        # Replaces the hashes of the keys of the last group by its filters
+        if (self._bloomGroups and isinstance(self._bloomGroups[-1][2][0], set)):
+            group = self._bloomGroups[-1]
+            group[2] = [_buildBloomFilter(hashes, self.bloomFilterRate) for hashes in group[2]]
+
+    def _updateBloomFilters(self, dataOffset, values):
+        # values are those of the properties with Bloom filters
+        groupSize = _blockSize*self.bloomFilterBlocks
+        groups = self._bloomGroups
+        if (not groups or groups[-1][0]//groupSize != dataOffset//groupSize):
+            self._finishBloomGroup()
+            groups.append([dataOffset, 0, [set() for _ in self._bloomIndices]])
+        group = groups[-1]
+        group[1] += 1
+        for (hashes, index, value) in zip(group[2], self._bloomIndices, values):
+            typeType = self.scheme[index][1]
+            if (typeType in ("I", "U", "S")):
+                for item in (value or ()):
+                    hashes.add(_bloomHashes(item, typeType))
+            else:
+                if (value is None):
+                    value = _typesDictionary[typeType][0]
+                hashes.add(_bloomHashes(value, typeType))
 
-    def writeScheme(self):
+    def writeColumns(self, **columns):
+        """
+        Writes a batch of entries given as columns (requires numpy).
+
+        Each argument is a property of the scheme with the values for all
+        the entries: NumPy arrays (or sequences) for numeric (i, u, f, d)
+        properties, tuples (values, offsets) for numeric arrays (I, U, F, D),
+        as returned by DBGZReader.readColumns, and sequences of python
+        objects for the other types. Missing properties are written with
+        their default values. The entries are encoded into the same layout
+        as write, so files can be read by any DBGZReader.
+        """
+        import numpy as np
+        for name in columns:
+            if (name not in self.name2Index):
+                raise Exception("Property '"+name+"' not found in the scheme")
+        data, sizes = _encodeColumns(np, self.scheme, columns)
+        if (not len(sizes)):
+            return
+        if (self._sortKeyIndex is not None):
+            typeName, typeType = self.scheme[self._sortKeyIndex]
+            column = columns.get(typeName)
+            if (column is None):
+                column = [None]*len(sizes)
+            elif (typeType != "s"):
+                column = np.asarray(column).tolist()
+            sortKeys = self._checkSortKeys(list(column))
+        firstEntry = self.totalEntries
+        self.totalEntries += len(sizes)
+        if (self.alignedBlocks):
+            dataOffsets = []
+            end = 0
+            for size in sizes.tolist():
+                start, end = end, end+size
+                dataOffsets.append(self._alignedUpdate(data[start:end]))
+            dataOffsets = np.array(dataOffsets, dtype=np.int64)
+        else:
+            self._aggregatedUpdate(True)
+            dataOffsets = self.fd.data_tell()+np.cumsum(sizes)-sizes
+            self.fd.write(data)
+        if (self._sortKeyIndex is not None):
+            for (dataOffset, key) in zip(dataOffsets.tolist(), sortKeys):
+                self._addSortKeyBlock(dataOffset, key)
+        if (self._zoneIndices):
+            self._updateZonesColumns(np, dataOffsets, columns)
+        if (self._bloomIndices):
+            bloomColumns = []
+            for index in self._bloomIndices:
+                typeName, typeType = self.scheme[index]
+                column = columns.get(typeName)
+                if (column is None):
+                    column = [None]*len(sizes)
+                elif (typeType in ("I", "U")):
+                    values, offsets = column
+                    values = np.asarray(values).tolist()
+                    offsets = np.asarray(offsets).tolist()
+                    column = [values[offsets[entry]:offsets[entry+1]]
+                              for entry in range(len(sizes))]
+                elif (typeType in ("i", "u")):
+                    column = np.asarray(column).tolist()
+                bloomColumns.append(column)
+            for (dataOffset, values) in zip(dataOffsets.tolist(), zip(*bloomColumns)):
+                self._updateBloomFilters(dataOffset, values)
+        if (self.ordinalIndex):
+            sampled = (firstEntry+np.arange(len(sizes))) % self.ordinalIndex == 0
+            self._ordinalOffsets += dataOffsets[sampled].tolist()
+
+    def _compileScheme(self):
+        # Sets up the properties and codec of the scheme, returns the
+        # scheme data written at the beginning of the file
         self.name2Index = {}
         self.index2Name = []
         self.index2Type = []
@@ -248,20 +863,94 @@ class DBGZWriter():
             self.index2Type.append(_typesDictionary[typeType])
             data += string2Data(typeName)
             data += typeType.encode("utf8")
+        self._encode, self._decodeAsList, self._decodeAsDict = _compileCodec(
+            self.scheme)
+        return data
+
+    def writeScheme(self):
+        data = self._compileScheme()
         self.fd.write(struct.pack("<Q", len(data)))
         self.fd.write(data)
 
     def _aggregatedUpdate(self, flush=False):
+        if (self.alignedBlocks):
+            if (flush):
+                self._alignedFlush()
+            return
         if (flush or len(self.aggregatedData) > 2000):
             self.fd.write(self.aggregatedData)
             self.aggregatedData = b''
 
+    def _alignedUpdate(self, entryData):
+        # Ends the current block before an entry that would not fit in it.
+        # Returns the offset of the entry in the uncompressed data.
+        if (self.alignedSize+len(entryData) > _blockSize):
+            self._alignedFlush()
+            if (len(entryData) > _blockSize):
+                # Oversized entry, spans its own blocks
+                dataOffset = self.fd.data_tell()
+                startBlock = self.fd.tell() >> 16
+                self.fd.write(entryData)
+                self.fd.end_block()
+                if ("oversizedRanges" not in self.metadata):
+                    self.metadata["oversizedRanges"] = []
+                self.metadata["oversizedRanges"].append(
+                    (startBlock, self.fd.tell() >> 16))
+                return dataOffset
+        dataOffset = self.fd.data_tell()+self.alignedSize
+        self.alignedData.append(entryData)
+        self.alignedSize += len(entryData)
+        return dataOffset
+
+    def _alignedFlush(self):
+        if (self.alignedData):
+            self.fd.write(b"".join(self.alignedData))
+            self.fd.end_block()
+            self.alignedData = []
+            self.alignedSize = 0
+
 
 class DBGZReader():
-    def __init__(self, filename, *args, **kwargs):
+    def __init__(self, filename, *args, fields=None, **kwargs):
+        """
+        Opens a DBGZ file for reading.
+
+        Parameters
+        ----------
+        filename : str
+          Path of the file to be read.
+        fields : list of str
+          If given, only these properties are decoded by default (see read).
+          (optional)
+        Other arguments are passed to BgzfReader (e.g. readahead, threads,
+        use_mmap or cache_size).
+        """
+        self.filename = filename
+        self._readerArguments = (args, dict(kwargs, fields=fields))
         self.fd = BgzfReader(filename, mode="rb", *args, **kwargs)
-        self.entriesCount = self.readEntriesCount()
+        self.entriesCount, self.metadata = _readTrailer(self.fd._handle)
+        self.alignedBlocks = self.metadata.get("alignedBlocks", False)
+        self.zoneMaps = self.metadata.get("zoneMaps")
+        self.bloomFilters = self.metadata.get("bloomFilters")
+        self.sortKey = self.metadata.get("sortKey")
+        self._sortKeys = None
+        if (self.sortKey):
+            self._sortKeys = [key for (_, key) in self.sortKey["blocks"]]
+        self.ordinalEvery = None
+        self.ordinalPositions = None
+        if ("ordinalIndex" in self.metadata):
+            positions = array("Q")
+            positions.frombytes(self.metadata["ordinalIndex"]["positions"])
+            if (sys.byteorder == "big"):
+                positions.byteswap()
+            self.ordinalEvery = self.metadata["ordinalIndex"]["every"]
+            self.ordinalPositions = positions
         self._readScheme()
+        self._projectionDecoders = {}
+        self._predicates = {}
+        self.fields = fields
+        if (fields is not None):
+            self._decoders(fields)
         self.startPosition = self.fd.tell()
 
     def __enter__(self):
@@ -275,6 +964,155 @@ class DBGZReader():
     def reset(self):
         self.fd.seek(self.startPosition)
 
+    def __len__(self):
+        return self.entriesCount
+
+    def __getitem__(self, index):
+        """
+        Gets an entry (or a list of entries for slices) by its number.
+        Fast if the file has an ordinal index (see DBGZWriter and
+        generateOrdinalIndex), otherwise entries are skipped from the start.
+        """
+        if (isinstance(index, slice)):
+            indices = range(*index.indices(self.entriesCount))
+            if (not indices):
+                return []
+            ascending = indices if indices.step > 0 else indices[::-1]
+            if (ascending.step == 1):
+                self.seekEntry(ascending.start)
+                entries = self.read(len(ascending))
+            else:
+                # Only the selected entries are decoded, the others are
+                # skipped (or jumped over with the ordinal index)
+                entries = []
+                nextIndex = None
+                for entryIndex in ascending:
+                    if (nextIndex is None or (
+                            self.ordinalPositions is not None
+                            and entryIndex//self.ordinalEvery > nextIndex//self.ordinalEvery)):
+                        self.seekEntry(entryIndex)
+                    else:
+                        self._skipEntries(entryIndex-nextIndex)
+                    entries += self.read(1)
+                    nextIndex = entryIndex+1
+            return entries if indices.step > 0 else entries[::-1]
+        if (index < 0):
+            index += self.entriesCount
+        if (index < 0 or index >= self.entriesCount):
+            raise IndexError("Entry index out of range")
+        self.seekEntry(index)
+        return self.read(1)[0]
+
+    def seekEntry(self, index):
+        """
+        Moves to the entry with the given number (starting at 0), so that
+        it is the next one to be read.
+        """
+        if (self.ordinalPositions is not None and len(self.ordinalPositions)):
+            sample = min(index//self.ordinalEvery, len(self.ordinalPositions)-1)
+            self.fd.seek(self.ordinalPositions[sample])
+            index -= sample*self.ordinalEvery
+        else:
+            self.reset()
+        if (self._skipEntries(index) < index):
+            raise IndexError("Entry index out of range")
+
+    def _sortKeyDecoder(self):
+        if (not self.sortKey):
+            raise Exception("File has no sort key (see DBGZWriter)")
+        return self._decoders([self.sortKey["field"]])[0]
+
+    def seekKey(self, value):
+        """
+        Moves to the first entry whose sort key (see DBGZWriter) is not
+        smaller than value, so that it is the next one to be read. The
+        block is found by a binary search over the keys of the first entry
+        starting in each block, so only one or two blocks are decoded.
+        Returns the position of the entry, or None (at the end of the file)
+        if all the keys are smaller than value.
+        """
+        decode = self._sortKeyDecoder()
+        block = bisect_left(self._sortKeys, value)-1
+        if (block >= 0):
+            self.fd.seek(self.sortKey["blocks"][block][0])
+        else:
+            self.reset()
+        pointerSize = _calcSize("<Q")
+        while True:
+            position = self.fd.tell()
+            sizeData = self.fd.read(pointerSize)
+            if (not sizeData):
+                return None
+            dataSize, = struct.unpack("<Q", sizeData)
+            if (not decode(self.fd.read_view(dataSize))[0] < value):
+                self.fd.seek(position)
+                return position
+
+    def rangeScan(self, low=None, high=None, fields=None, getPositions=False, asList=False):
+        """
+        Iterates over the entries with low <= sort key < high (see
+        DBGZWriter), in order, starting at the position found by seekKey.
+
+        Parameters
+        ----------
+        low : value
+          Smallest key.
+          (defaults to the start of the file)
+        high : value
+          Key at which the iteration stops (not included).
+          (defaults to the end of the file)
+        fields : list of str
+          Properties to be decoded (see read).
+        getPositions : bool
+          If True, the position of the entries is also returned (see read).
+        asList : bool
+          If True, entries are returned as lists instead of dicts.
+        """
+        decodeKey = self._sortKeyDecoder()
+        decode = self._decoders(fields)[0 if asList else 1]
+        if (low is None):
+            self.reset()
+        elif (self.seekKey(low) is None):
+            return
+        pointerSize = _calcSize("<Q")
+        while True:
+            position = self.fd.tell()
+            sizeData = self.fd.read(pointerSize)
+            if (not sizeData):
+                break
+            dataSize, = struct.unpack("<Q", sizeData)
+            data = self.fd.read_view(dataSize)
+            if (high is not None and not decodeKey(data)[0] < high):
+                self.fd.seek(position)
+                break
+            entry = decode(data)
+            if (getPositions):
+                if (asList):
+                    entry.append(position)
+                else:
+                    entry["_position"] = position
+            yield entry
+
+    def generateOrdinalIndex(self, every=1000):
+        """
+        Builds the ordinal index (position of every every-th entry) of a
+        file written without one, by going over the size of each entry.
+        The index is kept in memory and used by seekEntry, fd[i] and fd[a:b].
+        """
+        savedPosition = self.currentPosition()
+        self.reset()
+        positions = array("Q")
+        while True:
+            position = self.currentPosition()
+            count = self._skipEntries(every)
+            if (count):
+                positions.append(position)
+            if (count < every):
+                break
+        self.fd.seek(savedPosition)
+        self.ordinalEvery = every
+        self.ordinalPositions = positions
+
     def currentPosition(self):
         return self.fd.tell()
 
@@ -297,13 +1135,10 @@ class DBGZReader():
                 yield entry
 
     def readEntriesCount(self):
-        count = 0
-        startPoint = self.fd._handle.tell()
-        pointerSize = _calcSize("<Q")
-        self.fd._handle.seek(-pointerSize, os.SEEK_END)
-        count, = struct.unpack("<Q", self.fd._handle.read(pointerSize))
-        self.fd._handle.seek(startPoint)
-        return count
+        return _readTrailer(self.fd._handle)[0]
+
+    def readMetadata(self):
+        return _readTrailer(self.fd._handle)[1]
 
     def _readScheme(self):
         pointerSize = _calcSize("<Q")
@@ -324,54 +1159,485 @@ class DBGZReader():
             self.name2Index[typeName] = typeIndex
             self.index2Name.append(typeName)
             self.index2Type.append(_typesDictionary[typeType])
-
-    def read(self, count=1, getPositions=False):
+        self._encode, self._decodeAsList, self._decodeAsDict = _compileCodec(
+            self.scheme)
+
+    def _decoders(self, fields=None):
+        # Decoders for the given properties (or the default ones)
+        if (fields is None):
+            fields = self.fields
+        if (fields is None):
+            return (self._decodeAsList, self._decodeAsDict)
+        fields = tuple(fields)
+        if (fields not in self._projectionDecoders):
+            for field in fields:
+                if (field not in self.name2Index):
+                    raise Exception("Property '"+field+"' not found in the scheme")
+            self._projectionDecoders[fields] = _compileDecoders(self.scheme, fields)
+        return self._projectionDecoders[fields]
+
+    def _readEntries(self, count, getPositions, fields, asList, where=None):
+        # Reads up to count entries, keeping only those matching where.
+        # Returns the entries and the number of entries that were read.
+        decode = self._decoders(fields)[0 if asList else 1]
+        predicate = self._predicate(where)
         pointerSize = _calcSize("<Q")
         entries = []
-        for _ in range(count):
+        readCount = 0
+        for readCount in range(1, count+1):
             position = self.fd.tell()
             sizeData = self.fd.read(pointerSize)
             if (not sizeData):
+                readCount -= 1
                 break
             dataSize, = struct.unpack("<Q", sizeData)
-            data = self.fd.read(dataSize)
-            entry = {}
-            currentPointer = 0
-            for (index, (default, encode, decode)) in enumerate(self.index2Type):
-                entry[self.index2Name[index]], currentPointer = decode(
-                    data, currentPointer)
+            data = self.fd.read_view(dataSize)
+            if (predicate is not None and not predicate(data)):
+                continue
+            entry = decode(data)
             if (getPositions):
-                entry["_position"] = position
+                if (asList):
+                    entry.append(position)
+                else:
+                    entry["_position"] = position
             entries.append(entry)
-        return entries
+        return (entries, readCount)
+
+    def read(self, count=1, getPositions=False, fields=None, where=None):
+        """
+        Reads up to count entries as dictionaries.
+        If fields is given (or set when opening the file), only these
+        properties are decoded, the others are skipped.
+        If where is given, entries not matching it are skipped (see scan),
+        so fewer than count entries may be returned before the end of file.
+        """
+        return self._readEntries(count, getPositions, fields, False, where)[0]
+
+    def readAsList(self, count=1, getPositions=False, fields=None, where=None):
+        """
+        Reads up to count entries as lists (in the order of the scheme, or
+        of fields if given, see read).
+        """
+        return self._readEntries(count, getPositions, fields, True, where)[0]
+
+    def _predicate(self, where):
+        # Compiled (and cached) predicate for the where conditions
+        if (not where):
+            return None
+        # Values of "in" conditions (e.g. lists) are made hashable
+        where = tuple((field, operation, frozenset(value))
+                      if operation in ("in", "not in") else (field, operation, value)
+                      for (field, operation, value) in where)
+        try:
+            return self._predicates[where]
+        except KeyError:
+            pass
+        except TypeError:
+            # Other unhashable values, can't be cached
+            return _compilePredicate(self.scheme, where, self.name2Index)
+        self._predicates[where] = _compilePredicate(self.scheme, where, self.name2Index)
+        return self._predicates[where]
+
+    def scan(self, where=None, fields=None, getPositions=False, asList=False):
+        """
+        Iterates over the entries matching all the conditions in where,
+        from the beginning of the file.
+
+        Parameters
+        ----------
+        where : list of (str, str, value)
+          Conditions as (property, operation, value), where operation is one
+          of "<", "<=", ">", ">=", "==", "!=", "in" or "not in". The
+          conditions are evaluated on the data of each entry, decoding only
+          the properties they use, so entries that do not match are never
+          decoded.
+        fields : list of str
+          Properties to be decoded for the matching entries (see read).
+        getPositions : bool
+          If True, the position of the entries is also returned (see read).
+        asList : bool
+          If True, entries are returned as lists instead of dicts.
+        """
+        for (entries, _) in self._scanBatches(where, fields, asList, getPositions):
+            for entry in entries:
+                yield entry
+
+    def _bloomConditions(self, where, elements=False):
+        # (index of the filter, hashes of the keys) for the == and in
+        # conditions on properties with Bloom filters. For arrays, the
+        # values are whole arrays, unless elements is True.
+        conditions = []
+        if (not self.bloomFilters):
+            return conditions
+        fieldIndices = {field: fieldIndex for (fieldIndex, field)
+                        in enumerate(self.bloomFilters["fields"])}
+        for (field, operation, value) in where or ():
+            if (field not in fieldIndices or operation not in ("==", "in")):
+                continue
+            typeType = self.scheme[self.name2Index[field]][1]
+            if (typeType in ("I", "U", "S") and not elements):
+                # An array equal to value has all its elements (nothing
+                # can be skipped for empty arrays or in conditions)
+                if (operation != "=="):
+                    continue
+                try:
+                    hashes = [_bloomHashes(item, typeType) for item in value]
+                except (TypeError, ValueError):
+                    continue
+                conditions += [(fieldIndices[field], [itemHashes]) for itemHashes in hashes]
+                continue
+            if (operation == "=="):
+                value = (value,)
+            try:
+                hashes = [_bloomHashes(item, typeType) for item in value]
+            except (TypeError, ValueError):
+                continue
+            conditions.append((fieldIndices[field], hashes))
+        return conditions
+
+    def _bloomGroupsMayMatch(self, conditions):
+        # For each group of blocks with Bloom filters, whether its entries
+        # may have one of the keys of each condition
+        return [all(any(_bloomMayContain(filters[fieldIndex], keyHashes)
+                        for keyHashes in hashes)
+                    for (fieldIndex, hashes) in conditions)
+                for (_, _, filters) in self.bloomFilters["groups"]]
+
+    def candidateBlocks(self, field, value):
+        """
+        Returns the (position, count) of the groups of blocks that may have
+        entries with the value (or, for arrays, an element equal to it) for
+        the property field, according to its Bloom filters (see
+        DBGZWriter). The entries can be read with readAt(position, count).
+        """
+        if (not self.bloomFilters or field not in self.bloomFilters["fields"]):
+            raise Exception("File has no Bloom filters for property '"+str(field)+"'")
+        conditions = self._bloomConditions([(field, "==", value)], elements=True)
+        if (not conditions):
+            return []
+        mayMatch = self._bloomGroupsMayMatch(conditions)
+        return [(position, count) for ((position, count, _), groupMayMatch)
+                in zip(self.bloomFilters["groups"], mayMatch) if groupMayMatch]
+
+    def _scanSegments(self, where):
+        # Splits the file in (position, count, mayMatch) parts according to
+        # the zone maps and Bloom filters, returns None if they can't be used
+        zoneFields = {}
+        if (where and self.zoneMaps):
+            for (fieldIndex, field) in enumerate(self.zoneMaps["fields"]):
+                isFloat = self.scheme[self.name2Index[field]][1] in ("f", "d")
+                zoneFields[field] = (fieldIndex, isFloat)
+        useZones = any(condition[0] in zoneFields for condition in where or ())
+        bloomConditions = self._bloomConditions(where)
+        if (useZones):
+            segments = [(position, count, _zoneMayMatch(zoneFields, statistics, where))
+                        for (position, count, statistics) in self.zoneMaps["zones"]]
+        elif (bloomConditions):
+            segments = [(position, count, True)
+                        for (position, count, _) in self.bloomFilters["groups"]]
+        else:
+            return None
+        if (bloomConditions):
+            # groups of blocks are made of whole zones
+            groupsMayMatch = self._bloomGroupsMayMatch(bloomConditions)
+            groupsStarts = [group[0] for group in self.bloomFilters["groups"]]
+            segments = [(position, count, mayMatch and groupsMayMatch[
+                bisect_right(groupsStarts, position)-1])
+                for (position, count, mayMatch) in segments]
+        return segments
+
+    def _scanBatches(self, where, fields, asList, getPositions, batchSize=100):
+        # Iterates over (entries, readCount) batches of the entries matching
+        # where, from the beginning of the file. Zones that can't match
+        # according to the zone maps or Bloom filters are skipped (with
+        # readCount entries).
+        segments = self._scanSegments(where)
+        if (segments is None):
+            self.reset()
+            while True:
+                entries, readCount = self._readEntries(
+                    batchSize, getPositions, fields, asList, where)
+                yield (entries, readCount)
+                if (readCount < batchSize):
+                    break
+            return
+        for (position, count, mayMatch) in segments:
+            if (not mayMatch):
+                yield ([], count)
+                continue
+            self.fd.seek(position)
+            while (count > 0):
+                entries, readCount = self._readEntries(
+                    min(batchSize, count), getPositions, fields, asList, where)
+                yield (entries, readCount)
+                if (not readCount):
+                    break
+                count -= readCount
+
+    def recordBlocks(self):
+        """
+        Iterates over the file offsets of the BGZF blocks starting with an
+        entry. Only available for files written with alignedBlocks=True.
+        Each of these blocks can be decoded on its own with readBlock.
+        """
+        if (not self.alignedBlocks):
+            raise Exception("File was not written with alignedBlocks=True")
+        oversizedRanges = self.metadata.get("oversizedRanges", [])
+        rangeIndex = 0
+        with open(self.fd._handle.name, "rb") as handle:
+            for blockStart, _ in BgzfBlockStarts(handle, self.startPosition >> 16):
+                # Skips the continuation blocks of oversized entries
+                while (rangeIndex < len(oversizedRanges)
+                       and oversizedRanges[rangeIndex][1] <= blockStart):
+                    rangeIndex += 1
+                if (rangeIndex < len(oversizedRanges)
+                        and oversizedRanges[rangeIndex][0] < blockStart):
+                    continue
+                yield blockStart
+
+    def readBlock(self, blockStart, getPositions=False, asList=False, fields=None):
+        """
+        Reads all the entries starting in the BGZF block at the file offset
+        blockStart (as given by recordBlocks).
+        Only available for files written with alignedBlocks=True.
+        """
+        if (not self.alignedBlocks):
+            raise Exception("File was not written with alignedBlocks=True")
+        return self._readTask(("blocks", [blockStart]), getPositions, fields, asList)[0]
+
+    def _readTask(self, task, getPositions=False, fields=None, asList=False, where=None):
+        # Reads the entries of a task from _scanTasks, keeping only those
+        # matching where. Returns the entries and the number of entries read.
+        if (task[0] == "range"):
+            _, position, count = task
+            self.fd.seek(position)
+            return self._readEntries(count, getPositions, fields, asList, where)
+        entries = []
+        readCount = 0
+        for blockStart in task[1]:
+            self.fd.seek(blockStart << 16)
+            while ((self.fd.tell() >> 16) == blockStart):
+                entry, count = self._readEntries(1, getPositions, fields, asList, where)
+                if (not count):
+                    break
+                entries += entry
+                readCount += count
+        return (entries, readCount)
+
+    def _skipEntries(self, count):
+        # Moves over entries without decoding them, returns how many were skipped
+        pointerSize = _calcSize("<Q")
+        for skipped in range(count):
+            sizeData = self.fd.read(pointerSize)
+            if (not sizeData):
+                return skipped
+            dataSize, = struct.unpack("<Q", sizeData)
+            self.fd.read_view(dataSize)
+        return count
+
+    def _scanTasks(self, chunkSize):
+        # Splits the file in tasks for _mapWorker. Blocks of aligned files
+        # can be used directly, otherwise the entries boundaries are found by
+        # going over the size of each entry (decompressing but not decoding).
+        # The position of this reader is not changed.
+        if (self.alignedBlocks):
+            blocks = []
+            for blockStart in self.recordBlocks():
+                blocks.append(blockStart)
+                if (len(blocks) >= chunkSize):
+                    yield ("blocks", blocks)
+                    blocks = []
+            if (blocks):
+                yield ("blocks", blocks)
+        else:
+            # A reader of its own, as this runs in the thread feeding the
+            # pool while the caller may still be using this one
+            with DBGZReader(self.filename) as reader:
+                while True:
+                    position = reader.currentPosition()
+                    count = reader._skipEntries(chunkSize)
+                    if (count):
+                        yield ("range", position, count)
+                    if (count < chunkSize):
+                        break
+
+    def map(self, function=None, processes=None, ordered=True, chunkSize=None, asList=False):
+        """
+        Applies a function to all the entries using a pool of processes.
+
+        Parameters
+        ----------
+        function : function
+          Function applied to each entry (dict, or list if asList is True).
+          It needs to be picklable (i.e., defined at the top level of a
+          module). If None, the entries themselves are returned.
+        processes : int
+          Number of worker processes.
+          (defaults to the number of CPUs)
+        ordered : bool
+          If True, the results follow the order of the entries in the file,
+          otherwise results are yielded as soon as they are ready.
+          (defaults to True)
+        chunkSize : int
+          Number of blocks (for files written with alignedBlocks=True) or
+          entries processed by a worker at a time.
+          (defaults to 16 blocks or 10000 entries)
+        asList : bool
+          If True, entries are decoded as lists instead of dicts.
+          (defaults to False)
 
-    def readAsList(self, count=1, getPositions=False):
+        Returns
+        -------
+        results : generator
+          The results of the function for each entry.
+        """
+        if (chunkSize is None):
+            chunkSize = 16 if self.alignedBlocks else 10000
+        args, kwargs = self._readerArguments
+        with multiprocessing.Pool(processes, initializer=_initMapWorker,
+                                  initargs=(self.filename, args, kwargs)) as pool:
+            tasks = ((function, asList, task) for task in self._scanTasks(chunkSize))
+            if (ordered):
+                results = pool.imap(_mapWorker, tasks)
+            else:
+                results = pool.imap_unordered(_mapWorker, tasks)
+            for chunkResults in results:
+                for result in chunkResults:
+                    yield result
+
+    def parallelEntries(self, processes=None, ordered=True, chunkSize=None):
+        """
+        Iterates over all the entries, decoded in a pool of processes.
+        (see map)
+        """
+        return self.map(None, processes=processes, ordered=ordered, chunkSize=chunkSize)
+
+    def readEncoded(self, count=1, fields=None):
+        """
+        Reads up to count entries without decoding them. Returns a list of
+        the data of each entry, with its size, which can be written to a
+        file with the same scheme with DBGZWriter.writeEncoded. If fields is
+        given, returns tuples (data, values) where values is the list of
+        the values of these properties.
+        """
         pointerSize = _calcSize("<Q")
+        if (fields is not None):
+            decode = self._decoders(fields)[0]
         entries = []
         for _ in range(count):
-            position = self.fd.tell()
             sizeData = self.fd.read(pointerSize)
             if (not sizeData):
                 break
             dataSize, = struct.unpack("<Q", sizeData)
             data = self.fd.read(dataSize)
-            entry = []
-            currentPointer = 0
-            for (index, (default, encode, decode)) in enumerate(self.index2Type):
-                entryValue, currentPointer = decode(data, currentPointer)
-                entry.append(entryValue)
-            if (getPositions):
-                entry.append(position)
-            entries.append(entry)
+            if (fields is None):
+                entries.append(sizeData+data)
+            else:
+                entries.append((sizeData+data, decode(data)))
         return entries
 
-    def readAt(self, position, count=1, getPositions=False):
+    def _readRawEntries(self, count):
+        # Reads the data of up to count entries (without decoding them)
+        pointerSize = _calcSize("<Q")
+        chunks = []
+        for _ in range(count):
+            sizeData = self.fd.read(pointerSize)
+            if (not sizeData):
+                break
+            dataSize, = struct.unpack("<Q", sizeData)
+            chunks.append(self.fd.read(dataSize))
+        return chunks
+
+    def readColumns(self, count=1, fields=None):
+        """
+        Reads up to count entries as columns of NumPy arrays (requires numpy).
+
+        Parameters
+        ----------
+        count : int
+          Maximum number of entries to be read.
+        fields : list of str
+          Properties to be read.
+          (defaults to all the properties of the scheme)
+
+        Returns
+        -------
+        columns : dict
+          Maps each property to an array: numeric properties (i, u, f, d)
+          are NumPy arrays (int64, uint64, float32, float64). Numeric arrays
+          (I, U, F, D) are tuples (values, offsets), where the values of
+          entry k are values[offsets[k]:offsets[k+1]]. Other types are
+          NumPy arrays of python objects. The dictionary is empty if there
+          are no entries left.
+        """
+        import numpy as np
+        if (fields is None):
+            fields = self.fields
+        if (fields is None):
+            fields = self.index2Name
+        for field in fields:
+            if (field not in self.name2Index):
+                raise Exception("Property '"+field+"' not found in the scheme")
+        chunks = self._readRawEntries(count)
+        if (not chunks):
+            return {}
+        return _decodeColumns(np, self.scheme, chunks, fields)
+
+    def readAt(self, position, count=1, getPositions=False, fields=None):
         self.fd.seek(int(position))
-        return self.read(count, getPositions)
+        return self.read(count, getPositions, fields)
 
-    def readAsListAt(self, position, count=1, getPositions=False):
+    def readAsListAt(self, position, count=1, getPositions=False, fields=None):
         self.fd.seek(int(position))
-        return self.readAsList(count, getPositions)
+        return self.readAsList(count, getPositions, fields)
+
+    def readMany(self, positions, getPositions=False, fields=None, asList=False):
+        """
+        Reads the entries at the given positions (e.g. from an index), in
+        any order. The positions are sorted so that each BGZF block is
+        loaded only once, in file order, and the blocks are decompressed in
+        parallel if the file was opened with threads larger than 1.
+
+        Parameters
+        ----------
+        positions : list of int
+          Positions of the entries (as returned with getPositions).
+        getPositions : bool
+          If True, the position of the entries is also returned (see read).
+        fields : list of str
+          Properties to be decoded (see read).
+        asList : bool
+          If True, entries are returned as lists instead of dicts.
+
+        Returns
+        -------
+        entries : list
+          The entries in the same order as positions (the same object for
+          repeated positions), None for positions without an entry.
+        """
+        positions = [int(position) for position in positions]
+        sortedPositions = sorted(set(positions))
+        blockStarts = sorted(set(position >> 16 for position in sortedPositions))
+        blockIndices = {blockStart: blockIndex for (blockIndex, blockStart)
+                        in enumerate(blockStarts)}
+        # Blocks loaded at a time, leaving room in the cache for the blocks
+        # of entries crossing a block boundary
+        window = max(1, self.fd.cache_size//_blockSize//2)
+        prefetchedEnd = 0
+        entries = {}
+        savedPosition = self.currentPosition()
+        try:
+            for position in sortedPositions:
+                blockIndex = blockIndices[position >> 16]
+                if (blockIndex >= prefetchedEnd):
+                    prefetchedEnd = blockIndex+window
+                    self.fd.prefetch(blockStarts[blockIndex:prefetchedEnd])
+                self.fd.seek(position)
+                entry, _ = self._readEntries(1, getPositions, fields, asList)
+                entries[position] = entry[0] if entry else None
+        finally:
+            self.fd.seek(savedPosition)
+        return [entries[position] for position in positions]
 
     def generateIndex(self,
                       key=None,
@@ -381,6 +1647,11 @@ class DBGZReader():
                       useDictionary=True,
                       showProgressbar=True,
                       maxCount=-1,
+                      where=None,
+                      sortedIndex=False,
+                      keyType=None,
+                      processes=1,
+                      invertedIndex=False,
                       ):
         """
         Generates an index for the given key.
@@ -411,99 +1682,640 @@ class DBGZReader():
         maxCount : int
           If given, will only index the first maxCount entries.
           (defaults to -1, which means all entries)
+        where : list of (str, str, value)
+          Conditions evaluated before decoding the entries (see scan), only
+          entries matching all of them are included in the index. Faster
+          than filterFunction.
+          (optional)
+        sortedIndex : bool
+          If True, the index saved to indicesPath is a sorted index, which
+          can be opened with SortedIndex and searched without loading it
+          into memory, instead of the format read by readIndicesDictionary.
+          (defaults to False)
+        keyType : str
+          Type of the keys in the sorted index: "s" (string), "i" (int64),
+          "u" (uint64) or "d" (double). Numeric keys are stored in binary
+          form and ordered numerically.
+          (defaults to the type of the key property in the scheme, or "s"
+          if keyFunction is given)
+        processes : int
+          Number of processes used to build the index (see generateIndexes).
+          (defaults to 1)
+        invertedIndex : bool
+          If True, the index saved to indicesPath is an inverted index, to
+          be opened with InvertedIndex, storing each key once with the
+          compressed list of positions of its entries. Best suited for
+          array properties and keys with many entries.
+          (defaults to False)
 
         Returns
         -------
         index : dict
           The index (only if indicesPath is not given)
         """
+        specification = {
+            "key": key,
+            "keyFunction": keyFunction,
+            "filterFunction": filterFunction,
+            "indicesPath": indicesPath,
+            "sortedIndex": sortedIndex,
+            "keyType": keyType,
+            "invertedIndex": invertedIndex,
+        }
+        return self.generateIndexes(
+            [specification],
+            useDictionary=useDictionary,
+            showProgressbar=showProgressbar,
+            maxCount=maxCount,
+            where=where,
+            processes=processes)[0]
+
+    def generateIndexes(self,
+                        specifications,
+                        useDictionary=True,
+                        showProgressbar=True,
+                        maxCount=-1,
+                        where=None,
+                        processes=1,
+                        chunkSize=None,
+                        temporaryDirectory=None,
+                        ):
+        """
+        Generates several indices with a single pass over the file.
+
+        Parameters
+        ----------
+        specifications : list of dict
+          One dictionary for each index, with the key, keyFunction,
+          filterFunction, indicesPath, sortedIndex, invertedIndex and
+          keyType arguments of generateIndex (only key or keyFunction is required). If a
+          keyFunction or filterFunction is given, "fields" can list the
+          properties it uses, so only these are decoded.
+        useDictionary : bool
+          If True, will use the dictionary representation for the keyFunction and filterFunction.
+          (detaults to True)
+        showProgressbar : bool
+          If True, will show a progressbar while indexing.
+          (defaults to True)
+        maxCount : int
+          If given, each index only includes the first maxCount entries
+          passing its filterFunction. Only for processes=1.
+          (defaults to -1, which means all entries)
+        where : list of (str, str, value)
+          Conditions evaluated before decoding the entries (see scan), only
+          entries matching all of them are included in the indices.
+          (optional)
+        processes : int
+          Number of worker processes, each building the indices for a part
+          of the file (as in map). The parts are merged in file order, and
+          the parts of sorted indices are sorted by the workers and merged
+          from temporary files. keyFunction and filterFunction need to be
+          picklable. None uses the number of CPUs.
+          (defaults to 1, no worker processes)
+        chunkSize : int
+          Number of blocks (for files written with alignedBlocks=True) or
+          entries processed by a worker at a time.
+          (defaults to 64 blocks or 100000 entries)
+        temporaryDirectory : str
+          Where the temporary files of sorted indices are created.
+          (defaults to the system temporary directory)
+
+        Returns
+        -------
+        indices : list
+          For each specification, the index as a dictionary if its
+          indicesPath is not given, None otherwise.
+        """
 
         if (showProgressbar):
             from tqdm.auto import tqdm
-        if (keyFunction is None):
-            if (key is None):
-                raise Exception("At least key or keyFunction must be given")
-            if (key not in self.name2Index):
-                raise Exception("Property '"+key+"' not found in the scheme")
-            propertyIndex = self.name2Index[key]
+        if (processes != 1 and maxCount >= 0):
+            raise Exception("maxCount can only be used with processes=1")
+        indices = []
+        hasFunctions = False
+        knownFields = True
+        fields = []
+        for specification in specifications:
+            key = specification.get("key")
+            keyFunction = specification.get("keyFunction")
+            filterFunction = specification.get("filterFunction")
+            keyType = specification.get("keyType")
+            if (keyFunction is None):
+                if (key is None):
+                    raise Exception("At least key or keyFunction must be given")
+                if (key not in self.name2Index):
+                    raise Exception("Property '"+key+"' not found in the scheme")
+                if (keyType is None):
+                    keyType = _schemeKeyTypes.get(
+                        self.scheme[self.name2Index[key]][1], "s")
+                if (key not in fields):
+                    fields.append(key)
+            if ((keyFunction is not None) or (filterFunction is not None)):
+                hasFunctions = True
+                if (specification.get("fields") is None):
+                    knownFields = False
+                else:
+                    for field in specification["fields"]:
+                        if (field not in fields):
+                            fields.append(field)
+            if (keyType is None):
+                keyType = "s"
+            indices.append({
+                "key": key,
+                "keyFunction": keyFunction,
+                "filterFunction": filterFunction,
+                "indicesPath": specification.get("indicesPath"),
+                "sortedIndex": (specification.get("sortedIndex", False)
+                                or specification.get("invertedIndex", False)),
+                "invertedIndex": specification.get("invertedIndex", False),
+                "keyType": keyType,
+            })
         # no point in using a dictionary if we don't have a filter or key function
-        if ((filterFunction is None) and (keyFunction is None)):
+        if (not hasFunctions):
             useDictionary = False
+        if (not knownFields or (hasFunctions and not useDictionary)):
+            # the functions get the entries with all their properties
+            # (given explicitly, not those the reader was opened with)
+            fields = list(self.index2Name)
+        for index in indices:
+            if (index["keyFunction"] is None):
+                if (useDictionary):
+                    index["property"] = index["key"]
+                else:
+                    index["property"] = fields.index(index["key"])
+
+        outputs = []
+        for index in indices:
+            if (index["indicesPath"] is None):
+                outputs.append({})
+            elif (index["sortedIndex"]):
+                if (index["invertedIndex"]):
+                    writerClass = InvertedIndexWriter
+                else:
+                    writerClass = SortedIndexWriter
+                outputs.append(writerClass(
+                    index["indicesPath"], keyType=index["keyType"],
+                    temporaryDirectory=temporaryDirectory))
+            else:
+                outputs.append(BgzfWriter(index["indicesPath"], "w"))
+        writtenEntries = [0]*len(indices)
         if (showProgressbar):
             estimatedCount = self.entriesCount
-            if (maxCount >= 0):
+            if (maxCount >= 0 and len(indices) == 1):
                 estimatedCount = maxCount
             pbar = tqdm(total=estimatedCount)
         savedPosition = self.currentPosition()
-        self.reset()
-        if (indicesPath is not None):
-            fd = BgzfWriter(indicesPath, "w")
+        if (processes == 1):
+            entriesCounts = [0]*len(indices)
+            for (entries, readCount) in self._scanBatches(where, fields, not useDictionary, True):
+                if (showProgressbar):
+                    pbar.update(readCount)
+                if (not readCount):
+                    break
+                for (indexNumber, key, position) in _indexPairs(
+                        indices, entries, useDictionary, entriesCounts, maxCount):
+                    output = outputs[indexNumber]
+                    if (indices[indexNumber]["indicesPath"] is None):
+                        if (key not in output):
+                            output[key] = []
+                        output[key].append(position)
+                    elif (indices[indexNumber]["sortedIndex"]):
+                        output.add(key, position)
+                    else:
+                        output.write(_indexRecord(key, position))
+                        writtenEntries[indexNumber] += 1
+                if (maxCount >= 0 and min(entriesCounts) >= maxCount):
+                    break
         else:
-            indexDictionary = {}
-        entriesCount = 0
-        writtenEntries = 0
-        while True:
-            if (useDictionary):
-                entries = self.read(100, True)
-            else:
-                entries = self.readAsList(100, True)
-            if (entries):
-                for entry in entries:
+            if (chunkSize is None):
+                chunkSize = 64 if self.alignedBlocks else 100000
+            args, kwargs = self._readerArguments
+            with multiprocessing.Pool(processes, initializer=_initMapWorker,
+                                      initargs=(self.filename, args, kwargs)) as pool:
+                tasks = ((indices, fields, useDictionary, where, temporaryDirectory, task)
+                         for task in self._scanTasks(chunkSize))
+                for (readCount, parts) in pool.imap(_indexWorker, tasks):
                     if (showProgressbar):
-                        pbar.update(1)
-                    if (filterFunction is not None and not filterFunction(entry)):
-                        continue
-                    entriesCount += 1
-                    if (maxCount >= 0 and entriesCount > maxCount):
-                        break
-                    else:
-                        if (keyFunction is not None):
-                            propertyValues = keyFunction(entry)
+                        pbar.update(readCount)
+                    for (indexNumber, part) in enumerate(parts):
+                        output = outputs[indexNumber]
+                        if (indices[indexNumber]["indicesPath"] is None):
+                            for (key, positions) in part.items():
+                                if (key not in output):
+                                    output[key] = positions
+                                else:
+                                    output[key] += positions
+                        elif (indices[indexNumber]["sortedIndex"]):
+                            if (part is not None):
+                                output._addRunFile(*part)
                         else:
-                            if (useDictionary):
-                                propertyValues = entry[key]
-                            else:
-                                propertyValues = entry[propertyIndex]
-                        if (useDictionary):
-                            position = entry["_position"]
-                        else:
-                            position = entry[-1]
-
-                        if (propertyValues is not None):
-                            if (not isinstance(propertyValues, tuple) and not isinstance(propertyValues, list)):
-                                propertyValues = (propertyValues,)
-                            for propertyValue in propertyValues:
-                                if (propertyValue is not None and propertyValue != ""):
-                                    if (indicesPath is not None):
-                                        writtenEntries += 1
-                                        data = str(
-                                            propertyValue).encode("utf8")
-                                        fd.write(struct.pack(
-                                            "<QQ", len(data)+8, position)+data)
-                                    else:
-                                        if (propertyValue not in indexDictionary):
-                                            indexDictionary[propertyValue] = []
-                                        indexDictionary[propertyValue].append(
-                                            position)
-            else:
-                break
-            if (maxCount >= 0 and entriesCount > maxCount):
-                break
+                            output.write(part[0])
+                            writtenEntries[indexNumber] += part[1]
 
         self.fd.seek(savedPosition)
         if (showProgressbar):
             pbar.refresh()
             pbar.close()
-        if (indicesPath is not None):
-            fd.close(extraData=struct.pack("<Q", writtenEntries))
-            return None
-        else:
-            return indexDictionary
+        results = []
+        for (indexNumber, index) in enumerate(indices):
+            if (index["indicesPath"] is None):
+                results.append(outputs[indexNumber])
+            elif (index["sortedIndex"]):
+                outputs[indexNumber].close()
+                results.append(None)
+            else:
+                outputs[indexNumber].close(
+                    extraData=struct.pack("<Q", writtenEntries[indexNumber]))
+                results.append(None)
+        return results
 
     def close(self):
         self.fd.close()
 
 
+def _mergeZoneStatistics(statistics, minimum, maximum, nulls):
+    # statistics is [minimum, maximum, nulls], minimum is None if unknown
+    if (minimum is not None):
+        if (statistics[0] is None or minimum < statistics[0]):
+            statistics[0] = minimum
+        if (statistics[1] is None or maximum > statistics[1]):
+            statistics[1] = maximum
+    statistics[2] += nulls
+
+
+def _zoneMayMatch(zoneFields, statistics, where):
+    """
+    Returns False if, according to the statistics of a zone, none of its
+    entries can satisfy all the conditions in where.
+    zoneFields maps each property with statistics to a tuple with its
+    index in statistics and whether it is a floating point property.
+    """
+    for (field, operation, value) in where:
+        if (field not in zoneFields):
+            continue
+        fieldIndex, isFloat = zoneFields[field]
+        minimum, maximum, nulls = statistics[fieldIndex]
+        # NaN values (for floats) are not in the minimum and maximum
+        # and never compare equal
+        hasNaN = isFloat and nulls > 0
+        if (minimum is None):
+            if (hasNaN and operation in ("!=", "not in")):
+                continue
+            return False
+        try:
+            if (operation == "<"):
+                mayMatch = minimum < value
+            elif (operation == "<="):
+                mayMatch = minimum <= value
+            elif (operation == ">"):
+                mayMatch = maximum > value
+            elif (operation == ">="):
+                mayMatch = maximum >= value
+            elif (operation == "=="):
+                mayMatch = minimum <= value <= maximum
+            elif (operation == "in"):
+                mayMatch = any(minimum <= item <= maximum for item in value)
+            elif (operation == "!="):
+                mayMatch = hasNaN or not (minimum == maximum == value)
+            else:
+                mayMatch = hasNaN or not (minimum == maximum and minimum in value)
+        except TypeError:
+            # Values that can't be compared to the statistics (e.g. None),
+            # left to the predicate
+            mayMatch = True
+        if (not mayMatch):
+            return False
+    return True
+
+
+# Types of the properties which can have Bloom filters
+_bloomTypes = ("i", "u", "s", "I", "U", "S")
+
+
+def _bloomHashes(value, typeType):
+    # Two 64 bits hashes of a key, from which the bits of the Bloom filters
+    # are derived (double hashing)
+    if (typeType in ("s", "S")):
+        data = str(value).encode("utf8")
+    else:
+        data = str(int(value)).encode("utf8")
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    return struct.unpack("<QQ", digest)
+
+
+def _buildBloomFilter(hashes, rate):
+    # Returns [number of hashes, bits] of a filter for the given key hashes
+    count = max(len(hashes), 1)
+    bitsCount = max(64, int(math.ceil(-count*math.log(rate)/(math.log(2)**2))))
+    bitsCount = (bitsCount+7)//8*8
+    hashesCount = max(1, int(round(bitsCount/count*math.log(2))))
+    bits = bytearray(bitsCount//8)
+    for (first, second) in hashes:
+        for index in range(hashesCount):
+            bit = (first+index*second) % bitsCount
+            bits[bit >> 3] |= 1 << (bit & 7)
+    return [hashesCount, bytes(bits)]
+
+
+def _bloomMayContain(bloomFilter, keyHashes):
+    hashesCount, bits = bloomFilter
+    bitsCount = len(bits)*8
+    first, second = keyHashes
+    for index in range(hashesCount):
+        bit = (first+index*second) % bitsCount
+        if (not bits[bit >> 3] & (1 << (bit & 7))):
+            return False
+    return True
+
+
+_whereOperations = {
+    "<": "<", "<=": "<=", ">": ">", ">=": ">=", "==": "==", "!=": "!=",
+    "in": "in", "not in": "not in",
+}
+
+
+def _compilePredicate(scheme, where, name2Index):
+    """
+    Generates a function taking the data of an entry and returning True if
+    all the (property, operation, value) conditions in where are satisfied.
+    Only the properties used by the conditions are decoded.
+    """
+    fields = []
+    for (field, operation, _) in where:
+        if (field not in name2Index):
+            raise Exception("Property '"+field+"' not found in the scheme")
+        if (operation not in _whereOperations):
+            raise Exception("Unknown operation '"+str(operation)+"'")
+        if (field not in fields):
+            fields.append(field)
+    namespace = {"_decode": _compileDecoders(scheme, fields)[0]}
+    conditions = []
+    for (conditionIndex, (field, operation, value)) in enumerate(where):
+        if (operation in ("in", "not in")):
+            value = frozenset(value)
+        namespace["_value%d" % conditionIndex] = value
+        conditions.append("(v[%d] %s _value%d)" % (
+            fields.index(field), _whereOperations[operation], conditionIndex))
+    lines = ["def predicate(data):",
+             "    v = _decode(data)",
+             "    return %s" % " and ".join(conditions)]
+    return _compileFunctions(namespace, lines)[0]
+
+
+_numpyTypes = {"i": "<i8", "u": "<u8", "f": "<f4", "d": "<f8"}
+
+
+def _gatherColumn(np, buffer, offsets, dtype):
+    # Values of dtype found at each of the offsets of the buffer
+    dtype = np.dtype(dtype)
+    indices = offsets[:, None]+np.arange(dtype.itemsize)
+    return buffer[indices].view(dtype).reshape(-1)
+
+
+def _gatherArrays(np, buffer, offsets, counts, dtype):
+    # Concatenated values of the arrays with counts items at the offsets
+    dtype = np.dtype(dtype)
+    counts = counts.astype(np.int64)
+    arrayOffsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=arrayOffsets[1:])
+    total = int(arrayOffsets[-1])
+    entryIndices = np.repeat(np.arange(len(counts)), counts)
+    itemIndices = np.arange(total)-arrayOffsets[:-1][entryIndices]
+    positions = offsets[entryIndices]+itemIndices*dtype.itemsize
+    return (_gatherColumn(np, buffer, positions, dtype), arrayOffsets)
+
+
+def _decodeColumns(np, scheme, chunks, fields):
+    """
+    Decodes the fields of the entries data in chunks into columns.
+    The position of each property is advanced for all the entries at once,
+    so that only the requested properties are decoded.
+    """
+    if (not fields):
+        return {}
+    sizes = np.fromiter((len(chunk) for chunk in chunks), dtype=np.int64, count=len(chunks))
+    offsets = np.zeros(len(chunks), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+    data = b"".join(chunks)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    requested = set(fields)
+    columns = {}
+    lastIndex = max(index for (index, (typeName, _)) in enumerate(scheme)
+                    if typeName in requested)
+    for (typeName, typeType) in scheme[:lastIndex+1]:
+        if (typeType in _numpyTypes):
+            dtype = np.dtype(_numpyTypes[typeType])
+            if (typeName in requested):
+                columns[typeName] = _gatherColumn(np, buffer, offsets, dtype)
+            offsets = offsets+dtype.itemsize
+        elif (typeType in _arrayTypesFormats):
+            dtype = np.dtype(_numpyTypes[typeType.lower()])
+            counts = _gatherColumn(np, buffer, offsets, "<u8").astype(np.int64)
+            offsets = offsets+8
+            if (typeName in requested):
+                columns[typeName] = _gatherArrays(np, buffer, offsets, counts, dtype)
+            offsets = offsets+counts*dtype.itemsize
+        else:
+            decode = _typesDictionary[typeType][2]
+            if (typeName in requested):
+                values = np.empty(len(chunks), dtype=object)
+                for (entryIndex, offset) in enumerate(offsets.tolist()):
+                    values[entryIndex] = decode(data, offset)[0]
+                columns[typeName] = values
+            if (typeType == "S"):
+                # Goes over each string of the arrays
+                remaining = _gatherColumn(np, buffer, offsets, "<u8").astype(np.int64)
+                offsets = offsets+8
+                while (np.any(remaining > 0)):
+                    active = remaining > 0
+                    lengths = _gatherColumn(np, buffer, offsets[active], "<u8").astype(np.int64)
+                    offsets[active] += 8+lengths
+                    remaining -= active
+            else:
+                # s and a are stored with their size
+                lengths = _gatherColumn(np, buffer, offsets, "<u8").astype(np.int64)
+                offsets = offsets+8+lengths
+    return {field: columns[field] for field in fields}
+
+
+def _scatterColumn(np, output, offsets, values):
+    # Writes the values (a NumPy array) to the output at the given offsets
+    itemSize = values.dtype.itemsize
+    indices = offsets[:, None]+np.arange(itemSize)
+    output[indices] = np.ascontiguousarray(values).view(np.uint8).reshape(-1, itemSize)
+
+
+def _scatterBytes(np, output, offsets, pieces):
+    # Copies each of the bytes pieces to the output at the given offsets
+    lengths = np.fromiter((len(piece) for piece in pieces), dtype=np.int64, count=len(pieces))
+    piecesOffsets = np.zeros(len(pieces), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=piecesOffsets[1:])
+    entryIndices = np.repeat(np.arange(len(pieces)), lengths)
+    positions = offsets[entryIndices]+np.arange(int(lengths.sum()))-piecesOffsets[entryIndices]
+    output[positions] = np.frombuffer(b"".join(pieces), dtype=np.uint8)
+
+
+def _encodeColumns(np, scheme, columns):
+    """
+    Encodes entries given as columns, returning the data of all the
+    entries (in the same layout as DBGZWriter.write) and their sizes.
+    """
+    count = None
+    for (typeName, typeType) in scheme:
+        if (typeName not in columns):
+            continue
+        column = columns[typeName]
+        if (typeType in _arrayTypesFormats):
+            columnCount = len(column[1])-1
+        else:
+            columnCount = len(column)
+        if (count is not None and columnCount != count):
+            raise Exception("Columns must have the same number of entries")
+        count = columnCount
+    if (count is None):
+        count = 0
+
+    # Size of each property for each entry, and how it is encoded
+    encodings = []
+    entrySizes = np.zeros(count, dtype=np.int64)
+    for (typeName, typeType) in scheme:
+        column = columns.get(typeName)
+        if (typeType in _numpyTypes):
+            dtype = np.dtype(_numpyTypes[typeType])
+            if (column is None):
+                values = np.full(count, _typesDictionary[typeType][0], dtype=dtype)
+            else:
+                values = np.asarray(column).astype(dtype)
+            encodings.append(("fixed", values))
+            entrySizes += dtype.itemsize
+        elif (typeType in _arrayTypesFormats):
+            dtype = np.dtype(_numpyTypes[typeType.lower()])
+            if (column is None):
+                values = np.zeros(0, dtype=dtype)
+                arrayOffsets = np.zeros(count+1, dtype=np.int64)
+            else:
+                values = np.asarray(column[0]).astype(dtype)
+                arrayOffsets = np.asarray(column[1]).astype(np.int64)
+            counts = np.diff(arrayOffsets)
+            encodings.append(("array", (values[arrayOffsets[0]:arrayOffsets[-1]], counts)))
+            entrySizes += 8+counts*dtype.itemsize
+        else:
+            default, encode, _ = _typesDictionary[typeType]
+            if (column is None):
+                pieces = [encode(default)]*count
+            else:
+                pieces = [encode(default if value is None else value) for value in column]
+            encodings.append(("bytes", pieces))
+            entrySizes += np.fromiter((len(piece) for piece in pieces), dtype=np.int64, count=count)
+
+    sizes = entrySizes+_calcSize("<Q")
+    output = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    offsets = np.zeros(count, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=offsets[1:])
+    _scatterColumn(np, output, offsets, entrySizes.astype("<u8"))
+    offsets = offsets+8
+    for (encodingType, values) in encodings:
+        if (encodingType == "fixed"):
+            _scatterColumn(np, output, offsets, values)
+            offsets = offsets+values.dtype.itemsize
+        elif (encodingType == "array"):
+            values, counts = values
+            _scatterColumn(np, output, offsets, counts.astype("<u8"))
+            offsets = offsets+8
+            itemSize = values.dtype.itemsize
+            entryIndices = np.repeat(np.arange(count), counts)
+            arrayOffsets = np.zeros(count, dtype=np.int64)
+            np.cumsum(counts[:-1], out=arrayOffsets[1:])
+            itemIndices = np.arange(len(values))-arrayOffsets[entryIndices]
+            _scatterColumn(np, output, offsets[entryIndices]+itemIndices*itemSize, values)
+            offsets = offsets+counts*itemSize
+        else:
+            _scatterBytes(np, output, offsets, values)
+            offsets = offsets+np.fromiter((len(piece) for piece in values), dtype=np.int64, count=count)
+    return (output.tobytes(), sizes)
+
+
+_workerReader = None
+
+
+def _initMapWorker(filename, args, kwargs):
+    global _workerReader
+    _workerReader = DBGZReader(filename, *args, **kwargs)
+
+
+def _mapWorker(parameters):
+    function, asList, task = parameters
+    entries, _ = _workerReader._readTask(task, asList=asList)
+    if (function is None):
+        return entries
+    return [function(entry) for entry in entries]
+
+
+def _indexPairs(indices, entries, useDictionary, entriesCounts=None, maxCount=-1):
+    # Iterates over the (index number, key, position) pairs to be added to
+    # the indices (see generateIndexes) for the given entries.
+    # entriesCounts keeps the number of entries included in each index, up
+    # to maxCount.
+    for entry in entries:
+        if (useDictionary):
+            position = entry["_position"]
+        else:
+            position = entry[-1]
+        for (indexNumber, index) in enumerate(indices):
+            filterFunction = index["filterFunction"]
+            if (filterFunction is not None and not filterFunction(entry)):
+                continue
+            if (maxCount >= 0):
+                if (entriesCounts[indexNumber] >= maxCount):
+                    continue
+                entriesCounts[indexNumber] += 1
+            if (index["keyFunction"] is not None):
+                propertyValues = index["keyFunction"](entry)
+            else:
+                propertyValues = entry[index["property"]]
+            if (propertyValues is None):
+                continue
+            if (not isinstance(propertyValues, tuple) and not isinstance(propertyValues, list)):
+                propertyValues = (propertyValues,)
+            for propertyValue in propertyValues:
+                if (propertyValue is not None and propertyValue != ""):
+                    yield (indexNumber, propertyValue, position)
+
+
+def _indexRecord(key, position):
+    # Record of an index file read by readIndicesDictionary
+    data = str(key).encode("utf8")
+    return struct.pack("<QQ", len(data)+8, position)+data
+
+
+def _indexWorker(parameters):
+    # Builds the parts of the indices for the entries of a task: partial
+    # dictionaries, sorted run files or the records of the index files.
+    indices, fields, useDictionary, where, temporaryDirectory, task = parameters
+    entries, readCount = _workerReader._readTask(
+        task, True, fields, not useDictionary, where)
+    pairs = [[] for _ in indices]
+    for (indexNumber, key, position) in _indexPairs(indices, entries, useDictionary):
+        pairs[indexNumber].append((key, position))
+    parts = []
+    for (index, indexPairs) in zip(indices, pairs):
+        if (index["indicesPath"] is None):
+            part = {}
+            for (key, position) in indexPairs:
+                if (key not in part):
+                    part[key] = []
+                part[key].append(position)
+        elif (index["sortedIndex"]):
+            part = None
+            if (indexPairs):
+                part = _writeRunFile(indexPairs, index["keyType"], temporaryDirectory)
+        else:
+            part = (b"".join([_indexRecord(key, position)
+                             for (key, position) in indexPairs]), len(indexPairs))
+        parts.append(part)
+    return (readCount, parts)
+
+
 def readIndicesDictionary(indicesDataPath, showProgressbar=False):
     if (showProgressbar):
         from tqdm.auto import tqdm
@@ -0,0 +1,620 @@
+
+import struct
+import sys
+import os
+import mmap
+import heapq
+import shutil
+import tempfile
+import itertools
+from array import array
+from bisect import bisect_right
+
+# Sorted index files (as written by SortedIndexWriter) are not compressed so
+# that they can be memory mapped and binary searched without being loaded:
+#
+#   header: magic, key type, number of pairs (8 bytes each)
+#   positions: one uint64 per pair, in key order
+#   for string keys:
+#     key offsets: number of pairs + 1 uint64 offsets into the keys data
+#     keys data: the utf8 encoded keys, one after the other
+#   for numeric keys:
+#     keys: one int64, uint64 or double per pair
+#
+# All the numbers are little-endian.
+#
+# Inverted indices (as written by InvertedIndexWriter) use the same layout,
+# with a single pair for each key. Its position is the offset of the key's
+# posting list in a postings section appended after the keys data. A
+# posting list is made of varints: the number of positions, then, for each
+# block of up to _postingsBlockSize positions, the difference between its
+# first position and the first position of the previous block and the size
+# in bytes of the block, followed by the blocks themselves. Each block has
+# the differences between its consecutive positions.
+_sortedIndexMagic = b"DBGZSIX1"
+_invertedIndexMagic = b"DBGZINV1"
+_postingsBlockSize = 128
+_headerStruct = struct.Struct("<8sQQ")
+
+# key types, (code in the header, array type code, conversion)
+_keyTypes = {
+    "s": (0, None, lambda key: str(key).encode("utf8")),
+    "i": (1, "q", int),
+    "u": (2, "Q", int),
+    "d": (3, "d", float),
+}
+_keyTypesByCode = {code: keyType for (keyType, (code, _, _)) in _keyTypes.items()}
+
+# scheme types and the key type used to index them
+_schemeKeyTypes = {
+    "i": "i",
+    "I": "i",
+    "u": "u",
+    "U": "u",
+    "f": "d",
+    "F": "d",
+    "d": "d",
+    "D": "d",
+}
+
+
+def _valuesToBytes(values, typeCode="Q"):
+    data = array(typeCode, values)
+    if (sys.byteorder == "big"):
+        data.byteswap()
+    return data.tobytes()
+
+
+def _valuesFromBytes(data, typeCode="Q"):
+    values = array(typeCode)
+    values.frombytes(data)
+    if (sys.byteorder == "big"):
+        values.byteswap()
+    return values
+
+
+# Maximum number of runs merged at once (more runs are first merged in
+# groups, so that the number of open files stays bounded)
+_maxMergedRuns = 64
+
+
+def _writeRun(pairs, handle, keyTypeCode):
+    # Writes sorted (key, position) pairs to a run file, returns their count.
+    # Runs store the pairs one after the other: the key size, position and
+    # key for string keys, the key and position for numeric keys.
+    count = 0
+    if (keyTypeCode is None):
+        for (key, position) in pairs:
+            handle.write(struct.pack("<QQ", len(key), position)+key)
+            count += 1
+    else:
+        pairStruct = struct.Struct("<"+keyTypeCode+"Q")
+        chunk = []
+        for pair in pairs:
+            chunk.append(pairStruct.pack(*pair))
+            if (len(chunk) >= 65536):
+                handle.write(b"".join(chunk))
+                count += len(chunk)
+                chunk = []
+        handle.write(b"".join(chunk))
+        count += len(chunk)
+    return count
+
+
+def _readRun(run, keyTypeCode):
+    handle = run[0]
+    handle.seek(0)
+    if (keyTypeCode is None):
+        while True:
+            header = handle.read(16)
+            if (len(header) < 16):
+                break
+            keySize, position = struct.unpack("<QQ", header)
+            yield (handle.read(keySize), position)
+    else:
+        pairStruct = struct.Struct("<"+keyTypeCode+"Q")
+        while True:
+            data = handle.read(pairStruct.size*65536)
+            if (not data):
+                break
+            yield from pairStruct.iter_unpack(data)
+
+
+def _encodeVarints(values, data=None):
+    if (data is None):
+        data = bytearray()
+    for value in values:
+        while (value >= 0x80):
+            data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        data.append(value)
+    return data
+
+
+def _decodeVarints(data, offset, count):
+    # Returns count varints from data starting at offset, and the offset
+    # after them
+    values = []
+    for _ in range(count):
+        value = 0
+        shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if (byte < 0x80):
+                break
+            shift += 7
+        values.append(value)
+    return (values, offset)
+
+
+def _encodePostings(positions):
+    # Posting list of sorted positions (see the inverted index layout)
+    blocks = []
+    blocksHeader = []
+    previousFirst = 0
+    for start in range(0, len(positions), _postingsBlockSize):
+        block = positions[start:start+_postingsBlockSize]
+        data = _encodeVarints(
+            [block[index+1]-block[index] for index in range(len(block)-1)])
+        blocks.append(data)
+        blocksHeader += [block[0]-previousFirst, len(data)]
+        previousFirst = block[0]
+    data = _encodeVarints([len(positions)])
+    _encodeVarints(blocksHeader, data)
+    for block in blocks:
+        data += block
+    return bytes(data)
+
+
+def _writeRunFile(pairs, keyType, directory=None):
+    """
+    Sorts (key, position) pairs and saves them to a new run file, which
+    can be added to a SortedIndexWriter with _addRunFile. Used to build
+    parts of an index in other processes. Returns the path of the file
+    and the number of pairs in it.
+    """
+    _, keyTypeCode, convertKey = _keyTypes[keyType]
+    pairs = [(convertKey(key), position) for (key, position) in pairs]
+    # NaN keys are not indexed
+    pairs = [pair for pair in pairs if pair[0] == pair[0]]
+    pairs.sort()
+    handle, path = tempfile.mkstemp(dir=directory, suffix=".run")
+    with os.fdopen(handle, "wb") as fd:
+        count = _writeRun(pairs, fd, keyTypeCode)
+    return (path, count)
+
+
+class SortedIndexWriter():
+    _magic = _sortedIndexMagic
+
+    def __init__(self, filename, keyType="s", runSize=1000000, temporaryDirectory=None):
+        """
+        Writes a sorted index, mapping keys to entries positions, which can
+        be looked up with SortedIndex without loading it into memory.
+
+        Pairs are added in any order. Up to runSize pairs are kept in
+        memory, larger indices are sorted in runs stored in temporary files
+        which are merged when the index is closed.
+
+        Parameters
+        ----------
+        filename : str
+          Path of the index file.
+        keyType : str
+          How the keys are stored and ordered: "s" for strings, "i" for
+          64 bits integers, "u" for 64 bits unsigned integers and "d" for
+          doubles. NaN keys are not indexed.
+          (defaults to "s")
+        runSize : int
+          Maximum number of pairs kept in memory.
+          (defaults to 1000000)
+        temporaryDirectory : str
+          Where the temporary files are created.
+          (defaults to the system temporary directory)
+        """
+        if (keyType not in _keyTypes):
+            raise Exception("Invalid key type '"+str(keyType)+"'")
+        self.filename = filename
+        self.keyType = keyType
+        self._keyCode, self._keyTypeCode, self._convertKey = _keyTypes[keyType]
+        self.runSize = runSize
+        self.temporaryDirectory = temporaryDirectory
+        self.pairs = []
+        self.runs = []
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add(self, key, position):
+        key = self._convertKey(key)
+        if (key != key):
+            # NaN
+            return
+        self.pairs.append((key, position))
+        self.count += 1
+        if (len(self.pairs) >= self.runSize):
+            self.pairs.sort()
+            self._addRun(self.pairs)
+            self.pairs = []
+
+    def _addRunFile(self, path, count):
+        """
+        Adds the pairs of a run file written by _writeRunFile. The file is
+        deleted when the index is closed.
+        """
+        self.runs.append((open(path, "rb"), path))
+        self.count += count
+
+    def _addRun(self, sortedPairs):
+        handle = tempfile.TemporaryFile(dir=self.temporaryDirectory)
+        _writeRun(sortedPairs, handle, self._keyTypeCode)
+        self.runs.append((handle, None))
+
+    def _closeRuns(self, runs):
+        for (handle, path) in runs:
+            handle.close()
+            if (path is not None):
+                os.remove(path)
+
+    def close(self):
+        while (len(self.runs) > _maxMergedRuns):
+            runs = self.runs[:_maxMergedRuns]
+            self.runs = self.runs[_maxMergedRuns:]
+            self._addRun(heapq.merge(*[_readRun(run, self._keyTypeCode) for run in runs]))
+            self._closeRuns(runs)
+        self.pairs.sort()
+        sortedPairs = heapq.merge(self.pairs, *[_readRun(run, self._keyTypeCode) for run in self.runs])
+        stringKeys = self._keyTypeCode is None
+        with open(self.filename, "wb") as fd, \
+                tempfile.TemporaryFile(dir=self.temporaryDirectory) as offsetsFile, \
+                tempfile.TemporaryFile(dir=self.temporaryDirectory) as keysFile:
+            # the header is written again once the number of pairs is known
+            fd.write(_headerStruct.pack(self._magic, self._keyCode, 0))
+            count = 0
+            keysOffset = 0
+            positions = []
+            offsets = [0] if stringKeys else []
+            keys = []
+            for (key, position) in self._indexedPairs(sortedPairs):
+                count += 1
+                positions.append(position)
+                if (stringKeys):
+                    keysFile.write(key)
+                    keysOffset += len(key)
+                    offsets.append(keysOffset)
+                else:
+                    keys.append(key)
+                if (len(positions) >= 65536):
+                    fd.write(_valuesToBytes(positions))
+                    offsetsFile.write(_valuesToBytes(offsets))
+                    keysFile.write(_valuesToBytes(keys, self._keyTypeCode or "Q"))
+                    positions = []
+                    offsets = []
+                    keys = []
+            fd.write(_valuesToBytes(positions))
+            offsetsFile.write(_valuesToBytes(offsets))
+            keysFile.write(_valuesToBytes(keys, self._keyTypeCode or "Q"))
+            for section in (offsetsFile, keysFile):
+                section.seek(0)
+                shutil.copyfileobj(section, fd)
+            self._writeSections(fd)
+            fd.seek(0)
+            fd.write(_headerStruct.pack(self._magic, self._keyCode, count))
+        self._closeRuns(self.runs)
+        self.runs = []
+        self.pairs = []
+
+    def _indexedPairs(self, sortedPairs):
+        # The (key, position) pairs stored in the index
+        return sortedPairs
+
+    def _writeSections(self, fd):
+        # Writes the sections after the keys data
+        pass
+
+
+class InvertedIndexWriter(SortedIndexWriter):
+    _magic = _invertedIndexMagic
+
+    def __init__(self, filename, keyType="s", runSize=1000000, temporaryDirectory=None):
+        """
+        Writes an inverted index, in which each key is stored once with the
+        compressed list of the positions of its entries (delta encoded
+        varints), useful for properties with many repeated values, such as
+        the elements of arrays. Opened with InvertedIndex.
+        The parameters are the same as for SortedIndexWriter.
+        """
+        super().__init__(filename, keyType, runSize, temporaryDirectory)
+        self._postingsFile = None
+
+    def _indexedPairs(self, sortedPairs):
+        self._postingsFile = tempfile.TemporaryFile(dir=self.temporaryDirectory)
+        postingsOffset = 0
+        for (key, pairs) in itertools.groupby(sortedPairs, key=lambda pair: pair[0]):
+            positions = []
+            for (_, position) in pairs:
+                # positions repeated for the same key are stored once
+                if (not positions or positions[-1] != position):
+                    positions.append(position)
+            data = _encodePostings(positions)
+            self._postingsFile.write(data)
+            yield (key, postingsOffset)
+            postingsOffset += len(data)
+
+    def _writeSections(self, fd):
+        self._postingsFile.seek(0)
+        shutil.copyfileobj(self._postingsFile, fd)
+        self._postingsFile.close()
+        self._postingsFile = None
+
+
+class SortedIndex():
+    _magic = _sortedIndexMagic
+    _description = "sorted index"
+
+    def __init__(self, filename):
+        """
+        Opens a sorted index (see SortedIndexWriter) by memory mapping it.
+        Lookups are binary searches, so only the touched pages of the index
+        are read from disk.
+        """
+        self.filename = filename
+        self._handle = open(filename, "rb")
+        self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, keyCode, self.count = _headerStruct.unpack_from(self._mmap, 0)
+        if (magic != self._magic):
+            raise Exception("Not a valid "+self._description+" file: "+str(filename))
+        if (keyCode not in _keyTypesByCode):
+            raise Exception("Unsupported key type in "+self._description+" file: "+str(filename))
+        self.keyType = _keyTypesByCode[keyCode]
+        _, self._keyTypeCode, self._convertKey = _keyTypes[self.keyType]
+        self._positionsOffset = _headerStruct.size
+        if (self._keyTypeCode is None):
+            self._keyOffsetsOffset = self._positionsOffset+8*self.count
+            self._keysOffset = self._keyOffsetsOffset+8*(self.count+1)
+            self._keysEnd = self._keysOffset+struct.unpack_from(
+                "<Q", self._mmap, self._keyOffsetsOffset+8*self.count)[0]
+        else:
+            self._keysOffset = self._positionsOffset+8*self.count
+            self._keyStruct = struct.Struct("<"+self._keyTypeCode)
+            self._keysEnd = self._keysOffset+8*self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _position(self, index):
+        return struct.unpack_from("<Q", self._mmap, self._positionsOffset+8*index)[0]
+
+    def _value(self, index):
+        # Value yielded with the key of a pair
+        return self._position(index)
+
+    def _key(self, index):
+        if (self._keyTypeCode is not None):
+            return self._keyStruct.unpack_from(self._mmap, self._keysOffset+8*index)[0]
+        start, end = struct.unpack_from("<QQ", self._mmap, self._keyOffsetsOffset+8*index)
+        return self._mmap[self._keysOffset+start:self._keysOffset+end]
+
+    def _encodeKey(self, key):
+        return self._convertKey(key)
+
+    def _decodeKey(self, key):
+        if (self._keyTypeCode is None):
+            return key.decode("utf8")
+        return key
+
+    def _bisect(self, key, right=False):
+        # Index of the first pair with a key >= key (> key if right)
+        low, high = 0, self.count
+        while (low < high):
+            middle = (low+high)//2
+            middleKey = self._key(middle)
+            if (middleKey < key or (right and middleKey == key)):
+                low = middle+1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, key):
+        """
+        Returns the list of positions of the entries with the given key.
+        """
+        key = self._encodeKey(key)
+        start = self._bisect(key)
+        end = self._bisect(key, right=True)
+        return [self._position(index) for index in range(start, end)]
+
+    def range(self, low=None, high=None):
+        """
+        Iterates over the (key, position) pairs with low <= key < high, in
+        key order. low or high can be None for an open interval.
+        """
+        start = 0 if low is None else self._bisect(self._encodeKey(low))
+        end = self.count if high is None else self._bisect(self._encodeKey(high))
+        for index in range(start, end):
+            yield (self._decodeKey(self._key(index)), self._value(index))
+
+    def prefix(self, prefix):
+        """
+        Iterates over the (key, position) pairs with keys starting with
+        prefix, in key order. Only for indices with string keys.
+        """
+        if (self._keyTypeCode is not None):
+            raise Exception("Prefix lookups are only supported for string keys")
+        prefix = self._encodeKey(prefix)
+        for index in range(self._bisect(prefix), self.count):
+            key = self._key(index)
+            if (not key.startswith(prefix)):
+                break
+            yield (self._decodeKey(key), self._value(index))
+
+    def items(self):
+        """
+        Iterates over all the (key, position) pairs, in key order.
+        """
+        return self.range()
+
+    def toDictionary(self):
+        """
+        Loads the whole index as a dictionary mapping each key to the list
+        of positions of its entries (like readIndicesDictionary).
+        """
+        positions = _valuesFromBytes(
+            self._mmap[self._positionsOffset:self._positionsOffset+8*self.count])
+        if (self._keyTypeCode is None):
+            offsets = _valuesFromBytes(
+                self._mmap[self._keyOffsetsOffset:self._keysOffset])
+            keysData = self._mmap[self._keysOffset:self._keysOffset+offsets[-1]]
+            keys = [str(keysData[offsets[index]:offsets[index+1]], "utf8")
+                    for index in range(self.count)]
+        else:
+            keys = _valuesFromBytes(
+                self._mmap[self._keysOffset:self._keysOffset+8*self.count], self._keyTypeCode)
+        value2Positions = {}
+        for (key, position) in zip(keys, positions):
+            if (key not in value2Positions):
+                value2Positions[key] = []
+            value2Positions[key].append(position)
+        return value2Positions
+
+    def close(self):
+        self._mmap.close()
+        self._handle.close()
+
+
+class InvertedIndex(SortedIndex):
+    _magic = _invertedIndexMagic
+    _description = "inverted index"
+
+    def __init__(self, filename):
+        """
+        Opens an inverted index (see InvertedIndexWriter) by memory mapping
+        it. Only the posting lists of the looked up keys are decoded.
+        range, prefix and items iterate over (key, positions) pairs.
+        """
+        super().__init__(filename)
+
+    def _find(self, key):
+        # Index of the pair with the given key, None if not found
+        key = self._encodeKey(key)
+        index = self._bisect(key)
+        if (index < self.count and self._key(index) == key):
+            return index
+        return None
+
+    def _postings(self, index):
+        # Reads the header of a posting list, returns the number of
+        # positions and, for each block, its first position, offset and
+        # number of positions
+        offset = self._keysEnd+self._position(index)
+        (count,), offset = _decodeVarints(self._mmap, offset, 1)
+        blocksCount = (count+_postingsBlockSize-1)//_postingsBlockSize
+        header, offset = _decodeVarints(self._mmap, offset, 2*blocksCount)
+        blocks = []
+        first = 0
+        for blockIndex in range(blocksCount):
+            first += header[2*blockIndex]
+            size = min(_postingsBlockSize, count-blockIndex*_postingsBlockSize)
+            blocks.append((first, offset, size))
+            offset += header[2*blockIndex+1]
+        return (count, blocks)
+
+    def _decodeBlock(self, block):
+        first, offset, size = block
+        positions = [first]
+        for delta in _decodeVarints(self._mmap, offset, size-1)[0]:
+            first += delta
+            positions.append(first)
+        return positions
+
+    def _value(self, index):
+        positions = []
+        for block in self._postings(index)[1]:
+            positions += self._decodeBlock(block)
+        return positions
+
+    def lookup(self, key):
+        """
+        Returns the sorted list of positions of the entries with the given key.
+        """
+        index = self._find(key)
+        if (index is None):
+            return []
+        return self._value(index)
+
+    def frequency(self, key):
+        """
+        Returns the number of entries with the given key (without decoding
+        its posting list).
+        """
+        index = self._find(key)
+        if (index is None):
+            return 0
+        return _decodeVarints(self._mmap, self._keysEnd+self._position(index), 1)[0][0]
+
+    def intersection(self, keys):
+        """
+        Returns the sorted list of positions of the entries having all the
+        given keys. The shortest posting list is decoded first, for the
+        others only the blocks that may contain its positions are decoded.
+        """
+        postings = []
+        for key in keys:
+            index = self._find(key)
+            if (index is None):
+                return []
+            postings.append(self._postings(index))
+        if (not postings):
+            return []
+        postings.sort(key=lambda posting: posting[0])
+        positions = []
+        for block in postings[0][1]:
+            positions += self._decodeBlock(block)
+        for (_, blocks) in postings[1:]:
+            firsts = [block[0] for block in blocks]
+            matches = []
+            blockIndex = -1
+            blockPositions = set()
+            for position in positions:
+                positionBlock = bisect_right(firsts, position)-1
+                if (positionBlock < 0):
+                    continue
+                if (positionBlock != blockIndex):
+                    blockIndex = positionBlock
+                    blockPositions = set(self._decodeBlock(blocks[blockIndex]))
+                if (position in blockPositions):
+                    matches.append(position)
+            positions = matches
+            if (not positions):
+                break
+        return positions
+
+    def union(self, keys):
+        """
+        Returns the sorted list of positions of the entries having any of
+        the given keys.
+        """
+        positions = []
+        for position in heapq.merge(*[self.lookup(key) for key in keys]):
+            if (not positions or positions[-1] != position):
+                positions.append(position)
+        return positions
+
+    def toDictionary(self):
+        """
+        Loads the whole index as a dictionary mapping each key to the sorted
+        list of positions of its entries.
+        """
+        return dict(self.items())
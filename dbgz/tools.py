@@ -0,0 +1,428 @@
+
+from .dbgz import DBGZReader
+from .dbgz import DBGZWriter
+from .dbgz import _packTrailer
+from .dbgz import _trailerOffset
+from .bgzf import BgzfReader
+from .bgzf import BgzfWriter
+from .bgzf import _bgzf_eof
+from .bgzf import _compress_bgzf_block
+from .bgzf import _load_bgzf_block
+from .index import _maxMergedRuns
+import hashlib
+import heapq
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+
+def _copyBytes(source, destination, start, end, chunkSize=1 << 20):
+    source.seek(start)
+    while (start < end):
+        data = source.read(min(chunkSize, end-start))
+        if (not data):
+            raise Exception("Unexpected end of file")
+        destination.write(data)
+        start += len(data)
+
+
+class _PositionsMap():
+    # Maps the positions (virtual offsets) of the entries of one of the
+    # files being concatenated to their positions in the output file.
+    # The block in which the entries start (firstBlock) may have been
+    # written again without the scheme data before them (at within offset
+    # firstWithin), the following blocks are shifted by blocksShift.
+    def __init__(self, firstBlock, firstWithin, newFirstBlock, blocksShift):
+        self.firstBlock = firstBlock
+        self.firstWithin = firstWithin
+        self.newFirstBlock = newFirstBlock
+        self.blocksShift = blocksShift
+
+    def block(self, block):
+        if (block == self.firstBlock):
+            return self.newFirstBlock
+        return block+self.blocksShift
+
+    def position(self, position):
+        block = position >> 16
+        within = position & 0xFFFF
+        if (block == self.firstBlock):
+            return (self.newFirstBlock << 16) | (within-self.firstWithin)
+        return ((block+self.blocksShift) << 16) | within
+
+
+def _mergeMetadata(inputsMetadata, positionsMaps, entriesCounts):
+    # Metadata of the concatenated file. Zone maps, Bloom filters and the
+    # ordinal index are kept if all the files have them with the same
+    # settings (and, for the ordinal index, if the files sizes keep the
+    # sampled entries aligned).
+    metadata = {}
+    if (all(fileMetadata.get("alignedBlocks", False) for fileMetadata in inputsMetadata)):
+        metadata["alignedBlocks"] = True
+        oversizedRanges = []
+        for (fileMetadata, positionsMap) in zip(inputsMetadata, positionsMaps):
+            for (startBlock, endBlock) in fileMetadata.get("oversizedRanges", []):
+                oversizedRanges.append(
+                    (positionsMap.block(startBlock), positionsMap.block(endBlock)))
+        if (oversizedRanges):
+            metadata["oversizedRanges"] = oversizedRanges
+    for (name, settings, listName) in (("zoneMaps", "fields", "zones"),
+                                       ("bloomFilters", "fields", "groups")):
+        if (not all(name in fileMetadata for fileMetadata in inputsMetadata)):
+            continue
+        fields = inputsMetadata[0][name][settings]
+        if (any(fileMetadata[name][settings] != fields for fileMetadata in inputsMetadata)):
+            continue
+        items = []
+        for (fileMetadata, positionsMap) in zip(inputsMetadata, positionsMaps):
+            for item in fileMetadata[name][listName]:
+                items.append([positionsMap.position(item[0])]+list(item[1:]))
+        metadata[name] = {settings: fields, listName: items}
+    if (all("ordinalIndex" in fileMetadata for fileMetadata in inputsMetadata)):
+        every = inputsMetadata[0]["ordinalIndex"]["every"]
+        if (all(fileMetadata["ordinalIndex"]["every"] == every for fileMetadata in inputsMetadata)
+                and all(count % every == 0 for count in entriesCounts[:-1])):
+            positions = array("Q")
+            for (fileMetadata, positionsMap) in zip(inputsMetadata, positionsMaps):
+                filePositions = array("Q")
+                filePositions.frombytes(fileMetadata["ordinalIndex"]["positions"])
+                if (sys.byteorder == "big"):
+                    filePositions.byteswap()
+                positions.extend(positionsMap.position(position) for position in filePositions)
+            if (sys.byteorder == "big"):
+                positions.byteswap()
+            metadata["ordinalIndex"] = {"every": every, "positions": positions.tobytes()}
+    sortKeys = [fileMetadata.get("sortKey") for fileMetadata in inputsMetadata]
+    if (all(sortKeys) and len(set(sortKey["field"] for sortKey in sortKeys)) == 1):
+        # kept if the files are also in order between them
+        blocks = []
+        last = None
+        for (sortKey, positionsMap) in zip(sortKeys, positionsMaps):
+            if (sortKey["blocks"]):
+                if (last is not None and not last <= sortKey["blocks"][0][1]):
+                    break
+                blocks += [[positionsMap.position(position), key]
+                           for (position, key) in sortKey["blocks"]]
+            if (sortKey["last"] is not None):
+                last = sortKey["last"]
+        else:
+            metadata["sortKey"] = {"field": sortKeys[0]["field"], "blocks": blocks, "last": last}
+    return metadata
+
+
+def _remapIndex(indicesPaths, positionsMaps, outputPath):
+    # Writes an index file (as read by readIndicesDictionary) with the
+    # records of the indices of the concatenated files
+    writtenEntries = 0
+    output = BgzfWriter(outputPath, "w")
+    for (indexPath, positionsMap) in zip(indicesPaths, positionsMaps):
+        with BgzfReader(indexPath, "rb") as fd:
+            while True:
+                data = fd.read(8*2)
+                if (len(data) < 8*2):
+                    break
+                dataSize, position = struct.unpack("<QQ", data)
+                key = fd.read(dataSize-8)
+                output.write(struct.pack(
+                    "<QQ", dataSize, positionsMap.position(position))+key)
+                writtenEntries += 1
+    output.close(extraData=struct.pack("<Q", writtenEntries))
+
+
+def concat(inputs, output, indices=None):
+    """
+    Concatenates DBGZ files with the same scheme into a new file, without
+    decoding or compressing their entries again: the compressed blocks are
+    copied as they are, only the first block of entries of each file after
+    the first is compressed again (without the scheme before them).
+
+    The zone maps, Bloom filters, ordinal index and aligned blocks of the
+    files are kept if all of them have the same settings, and so is the
+    sort key if the files are also in order between them.
+
+    Parameters
+    ----------
+    inputs : list of str
+      Paths of the files to be concatenated, in order.
+    output : str
+      Path of the concatenated file.
+    indices : dict
+      Maps the path of an index of the output file to the list of paths
+      of the same index (as saved by generateIndex) for each of the input
+      files. Their positions are updated to those of the output file.
+      (optional)
+    """
+    if (not inputs):
+        raise Exception("At least one input file must be given")
+    scheme = None
+    inputsMetadata = []
+    entriesCounts = []
+    positionsMaps = []
+    with open(output, "wb") as outputHandle:
+        for (inputIndex, inputPath) in enumerate(inputs):
+            with DBGZReader(inputPath) as reader:
+                if (scheme is None):
+                    scheme = reader.scheme
+                elif (reader.scheme != scheme):
+                    raise Exception("The scheme of "+str(inputPath)+" does not match the scheme of "+str(inputs[0]))
+                inputsMetadata.append(reader.metadata)
+                entriesCounts.append(reader.entriesCount)
+                startPosition = reader.startPosition
+                handle = reader.fd._handle
+                dataEnd = _trailerOffset(handle)
+                handle.seek(dataEnd-len(_bgzf_eof))
+                if (handle.read(len(_bgzf_eof)) == _bgzf_eof):
+                    dataEnd -= len(_bgzf_eof)
+                firstBlock = startPosition >> 16
+                firstWithin = startPosition & 0xFFFF
+                outputStart = outputHandle.tell()
+                if (inputIndex == 0):
+                    # copied as it is, with the scheme
+                    _copyBytes(handle, outputHandle, 0, dataEnd)
+                    positionsMaps.append(_PositionsMap(firstBlock, 0, firstBlock, 0))
+                    continue
+                copyStart = firstBlock
+                if (firstWithin and firstBlock < dataEnd):
+                    # entries start in the block with the scheme
+                    handle.seek(firstBlock)
+                    blockSize, data = _load_bgzf_block(handle)
+                    copyStart = firstBlock+blockSize
+                    if (firstWithin < len(data)):
+                        outputHandle.write(_compress_bgzf_block(data[firstWithin:]))
+                blocksShift = outputHandle.tell()-copyStart
+                _copyBytes(handle, outputHandle, copyStart, dataEnd)
+                positionsMaps.append(_PositionsMap(
+                    firstBlock, firstWithin, outputStart, blocksShift))
+        metadata = _mergeMetadata(inputsMetadata, positionsMaps, entriesCounts)
+        outputHandle.write(_bgzf_eof)
+        outputHandle.write(_packTrailer(sum(entriesCounts), metadata))
+    for (outputIndex, inputIndices) in (indices or {}).items():
+        if (len(inputIndices) != len(inputs)):
+            raise Exception("An index must be given for each input file")
+        _remapIndex(inputIndices, positionsMaps, outputIndex)
+
+
+def _shardOf(value, n):
+    # Stable (across runs and machines) shard of a key value
+    if (isinstance(value, str)):
+        data = value.encode("utf8")
+    elif (isinstance(value, (bytes, bytearray))):
+        data = bytes(value)
+    else:
+        data = repr(value).encode("utf8")
+    digest = hashlib.blake2b(data, digest_size=8).digest()
+    return int.from_bytes(digest, "little") % n
+
+
+def shard(inputPath, key, n, outputPattern, threads=None, chunkSize=10000, **kwargs):
+    """
+    Splits a DBGZ file into n files (shards) with the same scheme, by the
+    hash of the value of a property, so that all the entries with the same
+    value are in the same shard. Only the key property is decoded, the
+    entries are written to the shards as they are, and the blocks of all
+    the shards are compressed in parallel by a pool of threads.
+
+    Parameters
+    ----------
+    inputPath : str
+      Path of the file to be split.
+    key : str
+      Property used to choose the shard of each entry. The hash is stable,
+      the same value always goes to the same shard for the same n.
+    n : int
+      Number of shards.
+    outputPattern : str
+      Path of the shards, formatted with the index of the shard
+      (e.g. "shard_{}.dbgz").
+    threads : int
+      Number of threads used to compress the shards.
+      (defaults to the number of CPUs)
+    chunkSize : int
+      Number of entries read at a time.
+      (defaults to 10000)
+    Other arguments are passed to the DBGZWriter of each shard (e.g.
+    zoneMaps or bloomFilters).
+
+    Returns
+    -------
+    list of int
+      Number of entries written to each shard.
+    """
+    if (n < 1):
+        raise Exception("The number of shards must be at least 1")
+    if (threads is None):
+        threads = os.cpu_count() or 1
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+    writers = []
+    try:
+        with DBGZReader(inputPath) as reader:
+            if (key not in reader.name2Index):
+                raise Exception("Property '"+key+"' not found in the scheme")
+            for index in range(n):
+                # the shards share the limit of blocks waiting to be written
+                writers.append(DBGZWriter(outputPattern.format(index), reader.scheme,
+                                          threads=threads, executor=executor,
+                                          max_pending=4*threads//n, **kwargs))
+            while True:
+                entries = reader.readEncoded(chunkSize, fields=[key])
+                if (not entries):
+                    break
+                for (entryData, values) in entries:
+                    writers[_shardOf(values[0], n)].writeEncoded(entryData)
+        for writer in writers:
+            writer.close()
+    finally:
+        if (executor is not None):
+            executor.shutdown()
+    return [writer.totalEntries for writer in writers]
+
+
+# Estimated memory used by each entry kept in memory by sort, besides its data
+_sortEntryOverhead = 128
+
+
+def _readCount(entries, memory, chunkSize):
+    # Number of entries to be read next so that they use about memory
+    # bytes, given the last entries read
+    entryMemory = sum(len(entryData) for (entryData, _) in entries)/len(entries)+_sortEntryOverhead
+    return max(1, min(chunkSize, int(memory/entryMemory)))
+
+
+def _encodedEntries(path, key, chunkSize, memory):
+    # Iterates over the (key value, entry data) of a file, reading about
+    # memory bytes at a time (blocks are read in order, none is cached)
+    with DBGZReader(path, max_cache=1) as reader:
+        readCount = 1
+        while True:
+            entries = reader.readEncoded(readCount, fields=[key])
+            if (not entries):
+                break
+            for (entryData, values) in entries:
+                yield (values[0], entryData)
+            readCount = _readCount(entries, memory, chunkSize)
+
+
+def _temporaryWriter(scheme, temporaryDirectory, **kwargs):
+    handle, path = tempfile.mkstemp(dir=temporaryDirectory, suffix=".dbgz")
+    os.close(handle)
+    return (DBGZWriter(path, scheme, compresslevel=1, **kwargs), path)
+
+
+def sort(inputPath, output, key, memoryLimit=1 << 28, threads=None, chunkSize=10000,
+         temporaryDirectory=None, **kwargs):
+    """
+    Writes the entries of a DBGZ file sorted by a property to a new file,
+    using a bounded amount of memory. The entries are sorted in runs that
+    fit in memoryLimit, which are saved to temporary DBGZ files and then
+    merged into the output. Only the key property is decoded, the entries
+    are written as they are. The sort is stable and entries with NaN keys
+    are written at the end.
+
+    Parameters
+    ----------
+    inputPath : str
+      Path of the file to be sorted.
+    output : str
+      Path of the sorted file.
+    key : str
+      Property used to sort the entries.
+    memoryLimit : int
+      Approximate number of bytes of entries kept in memory.
+      (defaults to 256MB)
+    threads : int
+      Number of threads used to compress the runs and the output while
+      entries are read and sorted.
+      (defaults to the number of CPUs)
+    chunkSize : int
+      Maximum number of entries read at a time (fewer are read if they
+      would use more than a fraction of memoryLimit).
+      (defaults to 10000)
+    temporaryDirectory : str
+      Directory of the temporary files.
+      (defaults to the system temporary directory)
+    Other arguments are passed to the DBGZWriter of the output (e.g.
+    zoneMaps or bloomFilters).
+
+    Returns
+    -------
+    int
+      Number of entries written.
+    """
+    if (threads is None):
+        threads = os.cpu_count() or 1
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+    writerArguments = {"threads": threads, "executor": executor}
+    runsPaths = []
+    nanWriter = None
+    nanPath = None
+    try:
+        with DBGZReader(inputPath, max_cache=1) as reader:
+            if (key not in reader.name2Index):
+                raise Exception("Property '"+key+"' not found in the scheme")
+            scheme = reader.scheme
+            entries = []
+            usedMemory = 0
+            readCount = 1
+            while True:
+                chunk = reader.readEncoded(readCount, fields=[key])
+                if (not chunk):
+                    break
+                for (entryData, values) in chunk:
+                    value = values[0]
+                    if (value != value):
+                        # NaN, can not be compared
+                        if (nanWriter is None):
+                            nanWriter, nanPath = _temporaryWriter(
+                                scheme, temporaryDirectory, **writerArguments)
+                        nanWriter.writeEncoded(entryData)
+                        continue
+                    entries.append((value, entryData))
+                    usedMemory += len(entryData)+_sortEntryOverhead
+                    if (usedMemory >= memoryLimit):
+                        entries.sort(key=itemgetter(0))
+                        writer, path = _temporaryWriter(scheme, temporaryDirectory, **writerArguments)
+                        runsPaths.append(path)
+                        for (_, entryData) in entries:
+                            writer.writeEncoded(entryData)
+                        writer.close()
+                        entries = []
+                        usedMemory = 0
+                # each read uses about a tenth of memoryLimit
+                readCount = _readCount(chunk, memoryLimit/10, chunkSize)
+        entries.sort(key=itemgetter(0))
+        if (nanWriter is not None):
+            nanWriter.close()
+        while (len(runsPaths) > _maxMergedRuns):
+            runs = runsPaths[:_maxMergedRuns]
+            writer, path = _temporaryWriter(scheme, temporaryDirectory, **writerArguments)
+            # the merged run takes the place of its runs (merge is stable)
+            runsPaths.insert(_maxMergedRuns, path)
+            runMemory = memoryLimit/len(runs)
+            for (_, entryData) in heapq.merge(*[_encodedEntries(run, key, chunkSize, runMemory)
+                                                for run in runs], key=itemgetter(0)):
+                writer.writeEncoded(entryData)
+            writer.close()
+            del runsPaths[:_maxMergedRuns]
+            for run in runs:
+                os.remove(run)
+        # the entries in memory are the last ones read (merge is stable)
+        runMemory = max(memoryLimit-usedMemory, memoryLimit/10)/max(1, len(runsPaths))
+        sortedEntries = heapq.merge(*[_encodedEntries(run, key, chunkSize, runMemory)
+                                      for run in runsPaths], entries, key=itemgetter(0))
+        with DBGZWriter(output, scheme, **writerArguments, **kwargs) as writer:
+            for (_, entryData) in sortedEntries:
+                writer.writeEncoded(entryData)
+            if (nanPath is not None):
+                for (_, entryData) in _encodedEntries(nanPath, key, chunkSize, memoryLimit):
+                    writer.writeEncoded(entryData)
+        return writer.totalEntries
+    finally:
+        if (executor is not None):
+            executor.shutdown()
+        for path in runsPaths+([nanPath] if nanPath is not None else []):
+            if (os.path.exists(path)):
+                os.remove(path)